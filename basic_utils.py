@@ -1,6 +1,7 @@
 # FUNCTION TO SAVE FILES
 
 import os
+import pandas as pd
 import geopandas as gpd
 from shapely import wkb
 import numpy as np
@@ -54,7 +55,95 @@ def find_nearest_reli(row, ha_poly, radius=None):
 def convert_3D_to_2D(gdf):
 
     _drop_z = lambda geom: wkb.loads(wkb.dumps(geom, output_dimension=2))
-    gdf.geometry = gdf.geometry.transform(_drop_z)
+    gdf.geometry = gdf.geometry.map(_drop_z)
 
     return gdf
 
+
+# FUNCTIONS TO READ BIG FILES BY CHUNKS
+
+
+def csv_dtypes(path, chunksize=100000, **kwargs):
+    """
+    Types of the columns of a CSV file, read by chunks of chunksize rows
+    (first pass of read_csv_chunks). A column gets the same type in all the
+    chunks: text if any chunk has text, float if any chunk has decimals,
+    integer otherwise (nullable Int64 if values are missing). Chunks where
+    the column is empty are ignored, and empty columns are text.
+    """
+
+    kinds, missing = {}, set()
+    for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs):
+        for col, dtype in chunk.dtypes.items():
+            kinds.setdefault(col, set())
+            if chunk[col].isna().any():
+                missing.add(col)
+            if chunk[col].isna().all():
+                continue
+            if pd.api.types.is_bool_dtype(dtype):
+                kinds[col].add("bool")
+            elif pd.api.types.is_integer_dtype(dtype):
+                kinds[col].add("int")
+            elif pd.api.types.is_float_dtype(dtype):
+                # Integers with missing values are read as floats
+                values = chunk[col].dropna()
+                integral = (values % 1 == 0).all() and (
+                    values.abs() < 2 ** 63).all()
+                kinds[col].add("int" if integral else "float")
+            elif pd.api.types.is_object_dtype(
+                dtype
+            ) or pd.api.types.is_string_dtype(dtype):
+                kinds[col].add("str")
+            else:
+                # Parsed dates, etc.: left to pd.read_csv
+                kinds[col].add("other")
+
+    dtypes = {}
+    for col, kind in kinds.items():
+        if "other" in kind:
+            continue
+        if kind == {"bool"} and col not in missing:
+            dtypes[col] = bool
+        elif kind and kind <= {"int", "float"}:
+            if "float" in kind:
+                dtypes[col] = "float64"
+            else:
+                dtypes[col] = "Int64" if col in missing else "int64"
+        else:
+            dtypes[col] = str
+
+    return dtypes
+
+
+def read_csv_chunks(path, chunksize=100000, dtype=None, **kwargs):
+    """
+    Read a CSV file by chunks of chunksize rows (iterator of dataframes),
+    e.g. for db_utils.import_data_chunked. kwargs are given to pd.read_csv
+    (sep, encoding, ...). The types of the columns are first inferred from
+    the whole file (see csv_dtypes), so that all the chunks have the same
+    types; dtype (dict) overrides some of them.
+    """
+
+    if dtype is None or isinstance(dtype, dict):
+        dtype = dict(csv_dtypes(path, chunksize, **kwargs), **(dtype or {}))
+
+    return pd.read_csv(path, chunksize=chunksize, dtype=dtype, **kwargs)
+
+
+def read_file_chunks(path, chunksize=100000, **kwargs):
+    """
+    Read a vector file (shapefile, GPKG, ...) by batches of chunksize
+    features (iterator of geodataframes), e.g. for
+    db_utils.import_data_chunked. kwargs are given to gpd.read_file (layer,
+    ...).
+    """
+
+    start = 0
+    while True:
+        chunk = gpd.read_file(
+            path, rows=slice(start, start + chunksize), **kwargs)
+        if len(chunk) > 0:
+            yield chunk
+        if len(chunk) < chunksize:
+            break
+        start += chunksize
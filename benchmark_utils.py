@@ -0,0 +1,382 @@
+# benchmark_utils.py
+
+import argparse
+import random
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import geoadmin_utils as ga
+import geocoding_utils as g
+
+
+# Vocabulary of the synthetic street names
+STREET_TYPES = [
+    "RUE DE LA",
+    "RUE DU",
+    "AVENUE DE",
+    "AVENUE DES",
+    "CHEMIN DE",
+    "CHEMIN DES",
+    "ROUTE DE",
+    "PLACE DE LA",
+    "RUELLE DU",
+    "CH. DU",
+    "AV. DE",
+    "RTE DE",
+]
+STREET_NAMES = [
+    "GARE",
+    "LAC",
+    "MONTELLY",
+    "MORGES",
+    "PRES",
+    "BOIS",
+    "CHENE",
+    "ECOLE",
+    "MOULIN",
+    "CHATEAU",
+    "PONT",
+    "VIGNES",
+    "CHAMPS",
+    "JURA",
+    "ALPES",
+    "FORET",
+    "TILLEULS",
+    "CEDRES",
+    "SIGNAL",
+    "CROIX",
+    "EGLISE",
+    "COLLEGE",
+    "FONTAINE",
+    "VERGERS",
+    "CRET",
+    "LONGERAIE",
+    "GRANGES",
+    "TERREAUX",
+    "CHABLAIS",
+    "RIANT-MONT",
+]
+
+
+# FUNCTION TO GENERATE A SYNTHETIC REGBL
+
+
+def synthetic_regbl(
+    n_addresses=10000,
+    n_localities=50,
+    streets_per_locality=40,
+    zipf=1.2,
+    suffix_rate=0.1,
+    letter_rate=0.02,
+    seed=0,
+):
+    """
+    Generate a RegBL-like table of addresses (same columns as regbl_wrangling:
+    egid, strname, deinr, dplz4, gdename, gkode, gkodn), without any real
+    data.
+
+    Inputs:
+    n_addresses = number of addresses (buildings)
+    n_localities = number of NPA (two NPA share a municipality name)
+    streets_per_locality = number of distinct streets in each NPA
+    zipf = exponent of the Zipf distribution of the buildings among the
+    streets of a locality (a few long streets, many short ones)
+    suffix_rate = proportion of suffixed street numbers (e.g. 12a)
+    letter_rate = proportion of street numbers without digit (e.g. B)
+    seed = seed of the random generator
+
+    Outputs: the RegBL dataframe
+    """
+
+    rnd = np.random.default_rng(seed)
+
+    npas = 1000 + np.arange(n_localities)
+    gdenames = np.array(["VILLE %d" % (i // 2) for i in range(n_localities)])
+
+    # Streets of each locality, and their weights (Zipf)
+    streets = np.array(
+        [
+            "{} {}".format(
+                STREET_TYPES[i % len(STREET_TYPES)],
+                STREET_NAMES[(i // len(STREET_TYPES)) % len(STREET_NAMES)],
+            )
+            + ("" if i < len(STREET_TYPES) * len(STREET_NAMES)
+               else " " + str(i))
+            for i in range(streets_per_locality * 3)
+        ]
+    )
+    weights = 1 / np.arange(1, streets_per_locality + 1) ** zipf
+    weights = weights / weights.sum()
+
+    locality = rnd.integers(0, n_localities, n_addresses)
+    street = rnd.choice(streets_per_locality, n_addresses, p=weights)
+    # Each locality has its own subset of streets
+    offset = rnd.integers(0, len(streets) -
+                          streets_per_locality, n_localities)
+    strname = streets[offset[locality] + street]
+
+    deinr = rnd.integers(1, 200, n_addresses).astype(str).astype(object)
+    kind = rnd.random(n_addresses)
+    suffixed = kind < suffix_rate
+    deinr[suffixed] = deinr[suffixed] + rnd.choice(
+        ["a", "b", "c", "bis"], suffixed.sum()
+    )
+    letters = (kind >= suffix_rate) & (kind < suffix_rate + letter_rate)
+    deinr[letters] = rnd.choice(["A", "B", "C"], letters.sum())
+
+    regbl = pd.DataFrame(
+        {
+            "egid": 100000 + np.arange(n_addresses),
+            "strname": strname,
+            "deinr": deinr,
+            "dplz4": npas[locality],
+            "gdename": gdenames[locality],
+            "gkode": 2500000.0 + rnd.random(n_addresses) * 50000,
+            "gkodn": 1150000.0 + rnd.random(n_addresses) * 50000,
+        }
+    )
+
+    return regbl
+
+
+def synthetic_npa(regbl):
+    """
+    NPA centroids (Ortschaftsname, PLZ, E, N, see npa_centroid) of the
+    localities of a synthetic RegBL.
+    """
+
+    npa = (
+        regbl.groupby(["dplz4", "gdename"])[["gkode", "gkodn"]]
+        .mean()
+        .reset_index()
+        .rename(
+            columns={
+                "dplz4": "PLZ",
+                "gdename": "Ortschaftsname",
+                "gkode": "E",
+                "gkodn": "N",
+            }
+        )
+    )
+
+    return npa[["Ortschaftsname", "PLZ", "E", "N"]]
+
+
+def _typo(text, rnd):
+
+    text = list(text)
+    k = rnd.randrange(len(text))
+    op = rnd.random()
+    if op < 0.4:
+        text[k] = rnd.choice("AEIOUXZ")
+    elif op < 0.7 and len(text) > 1:
+        del text[k]
+    else:
+        text.insert(k, rnd.choice("AEIOUXZ"))
+
+    return "".join(text)
+
+
+def synthetic_queries(
+    regbl,
+    n_queries=1000,
+    typo_rate=0.15,
+    missing_number_rate=0.1,
+    unknown_number_rate=0.1,
+    unknown_npa_rate=0.05,
+    missing_street_rate=0.02,
+    seed=0,
+):
+    """
+    Generate noisy addresses to geocode from a (synthetic) RegBL: typos in
+    street names, missing or unknown street numbers, unknown NPA and missing
+    streets.
+
+    Outputs: a dataframe with the fields expected by get_coords (strname,
+    deinr, npa, ville) and the raw address (address, e.g. "Rue du Lac 12" or
+    "12, rue du lac") expected by split_address
+    """
+
+    rnd = random.Random(seed)
+    sample = regbl.sample(
+        n_queries, replace=len(regbl) < n_queries, random_state=seed
+    )
+
+    rows = []
+    for strname, deinr, npa, ville in zip(
+        sample.strname, sample.deinr, sample.dplz4, sample.gdename
+    ):
+        if rnd.random() < typo_rate:
+            strname = _typo(strname, rnd)
+        r = rnd.random()
+        if r < missing_number_rate:
+            deinr = np.nan
+        elif r < missing_number_rate + unknown_number_rate:
+            deinr = str(rnd.randint(200, 400))
+        if rnd.random() < unknown_npa_rate:
+            npa = 9000 + rnd.randint(0, 999)
+        if rnd.random() < missing_street_rate:
+            strname = np.nan
+
+        if not isinstance(strname, str):
+            address = np.nan
+        elif not isinstance(deinr, str):
+            address = strname.title()
+        elif rnd.random() < 0.2:
+            address = deinr + ", " + strname.lower()
+        else:
+            address = strname.title() + " " + deinr
+
+        rows.append((address, strname, deinr, npa, ville))
+
+    queries = pd.DataFrame(
+        rows, columns=["address", "strname", "deinr", "npa", "ville"]
+    )
+
+    return queries
+
+
+# FUNCTIONS TO MEASURE THE GEOCODING FUNCTIONS
+
+
+def measure(func, items, memory=True):
+    """
+    Apply func to each item and return (seconds, rows per second, peak
+    memory in MB). The peak memory is measured with tracemalloc in a second
+    run (tracing slows down the code, so it is not timed).
+    """
+
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    seconds = time.perf_counter() - start
+
+    peak = np.nan
+    if memory is True:
+        tracemalloc.start()
+        try:
+            for item in items:
+                func(item)
+            peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+
+    return seconds, len(items) / seconds if seconds > 0 else np.inf, peak
+
+
+def benchmark_geocoding(
+    sizes=(1000, 10000, 100000), n_queries=500, level=0.9, memory=True, seed=0
+):
+    """
+    Time split_address, find_egid, search_regbl and get_coords (with the RegBL
+    dataframe and with a RegBLIndex) on synthetic data of several sizes. The
+    GeoAdmin API is replaced by a local stub server (GeoAdminStubServer
+    without recordings, i.e. no result), so the benchmark runs offline.
+
+    Outputs: a dataframe with one row per function and RegBL size (rows,
+    seconds, rows/s, peak memory in MB)
+    """
+
+    results = []
+    previous = ga._default_client
+
+    with ga.GeoAdminStubServer() as server:
+        ga.set_default_client(
+            ga.GeoAdminClient(base_url=server.url, rate=10000, retries=0)
+        )
+        try:
+            for size in sizes:
+                regbl = synthetic_regbl(
+                    size, n_localities=max(2, size // 500), seed=seed)
+                npa = synthetic_npa(regbl)
+                queries = synthetic_queries(regbl, n_queries, seed=seed)
+                rows = [row for _, row in queries.iterrows()]
+                # search_regbl is only called on addresses with a street
+                street_rows = [
+                    row for row in rows if isinstance(row.strname, str)
+                ]
+
+                start = time.perf_counter()
+                index = g.RegBLIndex(regbl)
+                centroids = g.NPACentroids(npa)
+                seconds = time.perf_counter() - start
+                results.append(
+                    ("RegBLIndex", size, size, seconds, size / seconds, np.nan)
+                )
+
+                benchmarks = [
+                    ("split_address", g.split_address, list(queries.address)),
+                    ("find_egid", lambda row: g.find_egid(row, regbl), rows),
+                    (
+                        "search_regbl",
+                        lambda row: g.search_regbl(
+                            row, regbl, on="building", fuzzy_rue=True
+                        ),
+                        street_rows,
+                    ),
+                    (
+                        "get_coords",
+                        lambda row: g.get_coords(row.copy(), regbl, npa, level),
+                        rows,
+                    ),
+                    (
+                        "get_coords[RegBLIndex]",
+                        lambda row: g.get_coords(
+                            row.copy(), index, centroids, level
+                        ),
+                        rows,
+                    ),
+                ]
+                for name, func, items in benchmarks:
+                    g.fuzzy_cache.clear()
+                    seconds, rate, peak = measure(func, items, memory)
+                    results.append((name, size, len(items), seconds, rate, peak))
+                    print(
+                        "{:<24} RegBL {:>8}: {:>10.1f} rows/s".format(
+                            name, size, rate)
+                    )
+
+        finally:
+            ga.set_default_client(previous)
+
+    res = pd.DataFrame(
+        results,
+        columns=["function", "regbl_size", "rows",
+                 "seconds", "rows_per_s", "peak_mb"],
+    )
+
+    return res
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the geocoding functions on synthetic data."
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+        help="sizes of the synthetic RegBL",
+    )
+    parser.add_argument("--queries", type=int, default=500,
+                        help="number of addresses to geocode")
+    parser.add_argument("--level", type=float, default=0.9,
+                        help="fuzzy match cutoff")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="do not measure peak memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="CSV file of the results")
+    args = parser.parse_args()
+
+    res = benchmark_geocoding(
+        args.sizes, args.queries, args.level, not args.no_memory, args.seed
+    )
+    print(res.to_string(index=False))
+    if args.output is not None:
+        res.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,84 @@
 # db_utils.py
 
 import getpass
+import io
+import os
 from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
 import psycopg2 as ps
+from psycopg2 import sql
+import pandas as pd
 import geopandas as gpd
 import geoalchemy2
+import shapely
+
+
+# FIND THE PASSWORD OF A USER (PGPASSWORD OR .PGPASS FILE)
+def find_password(db, user, host="localhost", port=5432):
+
+    """
+    Password of the user, from the PGPASSWORD environment variable or from
+    the password file (PGPASSFILE, ~/.pgpass by default, lines
+    hostname:port:database:username:password with * wildcards). Returns None
+    if no password is found.
+    """
+
+    if os.environ.get("PGPASSWORD"):
+        return os.environ["PGPASSWORD"]
+
+    path = os.environ.get("PGPASSFILE", os.path.expanduser("~/.pgpass"))
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        # Split on unescaped colons
+        fields, field, escaped = [], "", False
+        for ch in line:
+            if escaped:
+                field += ch
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == ":" and len(fields) < 4:
+                fields.append(field)
+                field = ""
+            else:
+                field += ch
+        fields.append(field)
+        if len(fields) != 5:
+            continue
+        if all(
+            f == "*" or f == str(v)
+            for f, v in zip(fields[:4], [host, port, db, user])
+        ):
+            return fields[4]
+
+    return None
 
 
 # CONNECT TO DB
 def connect_db(db, user):
 
     try:
-        pw = getpass.getpass()  # Ask for user password
+        pw = find_password(db, user)
+        if pw is None:
+            pw = getpass.getpass()  # Ask for user password
         engine = create_engine(
-            "postgresql+psycopg2://{}:{}@localhost/{}".format(user, pw, db)
+            URL.create(
+                "postgresql+psycopg2",
+                username=user,
+                password=pw,
+                host="localhost",
+                database=db,
+            )
         )  # Create SQLAlchemy engine
         conn = ps.connect(
-            "dbname='{}' user='{}' host='localhost' password='{}'".format(db, user, pw)
+            dbname=db, user=user, host="localhost", password=pw
         )  # Create a connection object
         cursor = conn.cursor()  # Create a cursor object
         print("Sucessfully connected to " + db.upper() + " DB")
@@ -26,32 +88,304 @@ def connect_db(db, user):
     return engine, conn, cursor
 
 
-# FUNCTION TO IMPORT DATA (SPATIAL OR NO) INTO DB
-def import_data(
-    db, user, dat, name, pk, schema="public", idx_geom=False, ifexists="replace"
+# SESSION ON THE DB (CONNECTIONS REUSED BY SEVERAL IMPORTS)
+class GeosanDB:
+
+    """
+    Session on a PostgreSQL DB holding a pooled SQLAlchemy engine and a raw
+    psycopg2 connection, to pass to the functions of this module
+    (session=...) so that consecutive calls reuse the same connections
+    instead of reconnecting (and asking for the password) each time. The
+    password is taken from PGPASSWORD or ~/.pgpass (see find_password), and
+    asked only if it is not found.
+
+    Usage:
+    with GeosanDB("geosan", "aladoy") as session:
+        import_data("geosan", "aladoy", dat, "name", "pk", session=session)
+    """
+
+    def __init__(
+        self, db, user, host="localhost", port=5432, password=None, pool_size=5
+    ):
+
+        self.db = db
+        self.user = user
+
+        if password is None:
+            password = find_password(db, user, host, port)
+        if password is None:
+            password = getpass.getpass()  # Ask for user password
+
+        self.engine = create_engine(
+            URL.create(
+                "postgresql+psycopg2",
+                username=user,
+                password=password,
+                host=host,
+                port=port,
+                database=db,
+            ),
+            pool_size=pool_size,
+            pool_pre_ping=True,
+        )  # Pooled SQLAlchemy engine
+        self.conn = ps.connect(
+            dbname=db, user=user, host=host, port=port, password=password
+        )  # Raw connection
+        self.cursor = self.conn.cursor()
+        print("Sucessfully connected to " + db.upper() + " DB")
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.close()
+
+    def close(self):
+
+        self.cursor.close()
+        self.conn.close()
+        self.engine.dispose()
+
+
+def _connect(db, user, session):
+
+    """Engine, connection and cursor of the session, or new ones (to close
+    after use) if there is no session."""
+
+    if session is None:
+        engine, conn, cursor = connect_db(db, user)
+        return engine, conn, cursor, True
+
+    return session.engine, session.conn, session.cursor, False
+
+
+# FUNCTIONS TO LOAD DATA WITH COPY (FASTER THAN INSERT)
+def sql_type(dtype):
+
+    """PostgreSQL type of a pandas dtype (same types as DataFrame.to_sql)."""
+
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_integer_dtype(dtype):
+        if dtype.itemsize <= 2:
+            return "smallint"
+        if dtype.itemsize <= 4:
+            return "integer"
+        return "bigint"
+    if pd.api.types.is_float_dtype(dtype):
+        return "real" if dtype.itemsize <= 4 else "double precision"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        if getattr(dtype, "tz", None) is not None:
+            return "timestamp with time zone"
+        return "timestamp without time zone"
+    if pd.api.types.is_timedelta64_dtype(dtype):
+        return "interval"
+
+    return "text"
+
+
+def geometry_type(dat, generic=False):
+
+    """PostGIS type of the geometry column, e.g. geometry(POINT, 2056), with
+    the same rules as GeoDataFrame.to_postgis (mixed types give GEOMETRY,
+    LinearRing gives LINESTRING, Z if any geometry has a Z coordinate).
+    generic=True gives GEOMETRY whatever the geometry types."""
+
+    has_z = bool(dat.geometry.has_z.any())
+    if generic:
+        target = "GEOMETRY" + ("Z" if has_z else "")
+    else:
+        target = _geometry_name(dat.geometry.geom_type.unique(), has_z)
+
+    srid = _srid(dat)
+
+    return "geometry({}, {})".format(target, srid), srid
+
+
+def _srid(dat):
+
+    """EPSG code of the CRS of a GeoDataFrame (0 if unknown)."""
+
+    if dat.crs is not None and dat.crs.to_epsg() is not None:
+        return dat.crs.to_epsg()
+
+    return 0
+
+
+def _geometry_name(geom_types, has_z):
+
+    """PostGIS name of the geometry type (e.g. POINT, GEOMETRYZ) of data with
+    the given geometry types (unique values of geom_type)."""
+
+    geom_types = list(geom_types)
+
+    if len(geom_types) == 1:
+        if pd.isna(geom_types[0]):
+            raise ValueError("No valid geometries in the data.")
+        if "LinearRing" in geom_types[0]:
+            target = "LINESTRING"
+        else:
+            target = geom_types[0].upper()
+    else:
+        target = "GEOMETRY"
+    if has_z:
+        target += "Z"
+
+    return target
+
+
+def table_ddl(
+    dat, name, schema="public", ifexists="replace", generic_geometry=False
 ):
 
-    engine, conn, cursor = connect_db(db, user)
+    """CREATE TABLE statement for a dataframe (geometry column included)."""
+
+    columns = []
+    for col, dtype in dat.dtypes.items():
+        if isinstance(dat, gpd.GeoDataFrame) and col == dat.geometry.name:
+            col_type = geometry_type(dat, generic_geometry)[0]
+        else:
+            col_type = sql_type(dtype)
+        columns.append(
+            sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL(col_type))
+        )
+
+    return sql.SQL("CREATE TABLE {}{} ({})").format(
+        sql.SQL("IF NOT EXISTS ") if ifexists == "append" else sql.SQL(""),
+        _table(name, schema),
+        sql.SQL(", ").join(columns),
+    )
+
+
+def _table(name, schema):
+
+    if schema is None:
+        return sql.Identifier(name)
+
+    return sql.Identifier(schema, name)
+
+
+def _copy_statement(cursor, table, columns):
+
+    return sql.SQL(
+        "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    ).format(
+        table, sql.SQL(", ").join(sql.Identifier(col) for col in columns)
+    ).as_string(cursor)
+
+
+def _integer_columns(cursor, table):
+
+    """Columns of a table (schema included, temporary tables too) with an
+    integer type."""
+
+    cursor.execute(
+        "SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass "
+        "AND attnum > 0 AND NOT attisdropped AND atttypid IN "
+        "('smallint'::regtype, 'integer'::regtype, 'bigint'::regtype);",
+        (table.as_string(cursor),),
+    )
+
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _copy_chunk(cursor, chunk, copy, int_columns=()):
+
+    chunk = chunk.copy()
+    for col in chunk.columns:
+        # Integers with missing values are floats in pandas (1.0 is not a
+        # valid integer for PostgreSQL). Other values are left to
+        # PostgreSQL (error if not integral or out of range)
+        if col in int_columns and pd.api.types.is_float_dtype(chunk[col]):
+            values = chunk[col].dropna()
+            if (values % 1 == 0).all() and (values.abs() < 2 ** 63).all():
+                chunk[col] = chunk[col].astype("Int64")
+
+    buffer = io.StringIO()
+    chunk.to_csv(buffer, index=False, header=False, na_rep="\\N")
+    buffer.seek(0)
+    cursor.copy_expert(copy, buffer)
+
+
+def copy_data(
+    cursor,
+    dat,
+    name,
+    schema="public",
+    ifexists="replace",
+    chunksize=100000,
+    generic_geometry=False,
+):
+
+    """
+    Load a dataframe (or geodataframe) into a table with COPY FROM STDIN:
+    the table is created from the dtypes (see table_ddl) and the rows are
+    streamed as CSV by chunks of chunksize rows, geometries as hex EWKB
+    (with the SRID of the CRS).
+    cursor: psycopg2 cursor (the transaction is not committed)
+    ifexists: "replace" (drop the table), "append" (add rows to the table)
+    or "fail" (error if the table exists)
+    generic_geometry: create the geometry column with the GEOMETRY type (any
+    geometry type, see geometry_type)
+    """
 
-    # drop table cascade if "replace" option
     if ifexists == "replace":
+        cursor.execute(
+            sql.SQL("DROP TABLE IF EXISTS {} CASCADE").format(
+                _table(name, schema))
+        )
+    cursor.execute(table_ddl(dat, name, schema, ifexists, generic_geometry))
 
-        try:
+    geom_col = None
+    if isinstance(dat, gpd.GeoDataFrame):
+        geom_col = dat.geometry.name
+        srid = geometry_type(dat)[1]
 
-            cursor.execute(
-                "select table_name from information_schema.tables where table_name = '{}' UNION select matviewname from pg_matviews where matviewname = '{}';".format(
-                    name, name
-                )
-            )
-            cursor.fetchone()[0]
+    copy = _copy_statement(cursor, _table(name, schema), dat.columns)
+    int_columns = _integer_columns(cursor, _table(name, schema))
 
-            cursor.execute("DROP TABLE {}.{} CASCADE;".format(schema, name))
-            print("DROP TABLE")
-            conn.commit()
+    for start in range(0, len(dat), chunksize):
+        chunk = pd.DataFrame(dat.iloc[start: start + chunksize])
+        if geom_col is not None:
+            geoms = shapely.set_srid(dat.geometry.values[
+                start: start + chunksize].to_numpy(), srid)
+            chunk[geom_col] = shapely.to_wkb(
+                geoms, hex=True, include_srid=True)
+        _copy_chunk(cursor, chunk, copy, int_columns)
 
-        except TypeError:
 
-            pass
+# FUNCTION TO IMPORT DATA (SPATIAL OR NO) INTO DB
+def import_data(
+    db,
+    user,
+    dat,
+    name,
+    pk,
+    schema="public",
+    idx_geom=False,
+    ifexists="replace",
+    session=None,
+    method="insert",
+):
+
+    """
+    Import a dataframe (or a geodataframe, into PostGIS) as a table, with
+    its primary key (pk, "NULL" for none) and a GIST index on the geometry
+    if idx_geom. method is "insert" (DataFrame.to_sql / to_postgis) or
+    "copy" (COPY FROM STDIN, much faster for big tables, see copy_data).
+    """
+
+    engine, conn, cursor, close = _connect(db, user, session)
+
+    # drop table cascade if "replace" option
+    if ifexists == "replace":
+        _drop_table(cursor, conn, name, schema)
 
     print(dat.shape)
     dat.columns = map(str.lower, dat.columns)  # convert columns to lower case
@@ -59,6 +393,140 @@ def import_data(
     if isinstance(dat, gpd.GeoDataFrame):
         print("Geometry Type :" + dat.geometry.geom_type.unique()[0])
         print("CRS :" + str(dat.crs))
+
+    _load(engine, cursor, dat, name, schema, ifexists, method)
+    conn.commit()
+
+    _finalize_table(cursor, conn, name, schema, pk, idx_geom)
+
+    if close:
+        conn.close()
+
+
+# FUNCTION TO IMPORT BIG DATA INTO DB BY CHUNKS (BOUNDED MEMORY)
+def import_data_chunked(
+    db,
+    user,
+    chunks,
+    name,
+    pk,
+    schema="public",
+    idx_geom=False,
+    ifexists="replace",
+    transform=None,
+    session=None,
+    method="copy",
+):
+
+    """
+    Same as import_data for data read by chunks (e.g. u.read_csv_chunks or
+    u.read_file_chunks), so that only one chunk is in memory at a time. Each
+    chunk is transformed (transform(chunk), e.g. conversion to 2D or accent
+    stripping), its columns are converted to lower case and it is appended
+    to the table. The primary key and the GIST index are created once, after
+    the last chunk.
+    The table is created from the first chunk: columns must have the same
+    types in all the chunks (u.read_csv_chunks infers them from the whole
+    file, otherwise use the dtype option of the reader).
+    The geometry column gets the type that geometry_type gives for all the
+    data, whatever the chunk boundaries: it is altered when a chunk brings a
+    new geometry type (e.g. POINT to GEOMETRY) or a Z coordinate. Once a
+    chunk has a Z coordinate, all the geometries are loaded in 3D (Z = 0
+    for the 2D ones).
+    """
+
+    engine, conn, cursor, close = _connect(db, user, session)
+
+    if ifexists == "replace":
+        _drop_table(cursor, conn, name, schema)
+
+    nb = 0
+    # Geometry types and Z of the chunks imported so far, type of the column
+    geom_types = set()
+    has_z = False
+    geom_type = None
+    for i, chunk in enumerate(chunks):
+        if transform is not None:
+            chunk = transform(chunk)
+        chunk.columns = map(str.lower, chunk.columns)
+
+        if isinstance(chunk, gpd.GeoDataFrame):
+            geom_col = chunk.geometry.name
+            geom_types.update(
+                None if pd.isna(t) else t
+                for t in chunk.geometry.geom_type.unique()
+            )
+            has_z = has_z or bool(chunk.geometry.has_z.any())
+            if has_z and not chunk.geometry.has_z.all():
+                chunk = chunk.set_geometry(
+                    shapely.force_3d(chunk.geometry.values), crs=chunk.crs
+                )
+
+            target = "geometry({}, {})".format(
+                _geometry_name(geom_types, has_z), _srid(chunk)
+            )
+            if geom_type is not None and target != geom_type:
+                # ST_Force3D gives Z = 0 to the 2D rows already imported
+                using = sql.Identifier(geom_col)
+                if has_z:
+                    using = sql.SQL("ST_Force3D({})").format(using)
+                cursor.execute(
+                    sql.SQL("ALTER TABLE {} ALTER COLUMN {} TYPE {} USING {};").format(
+                        _table(name, schema),
+                        sql.Identifier(geom_col),
+                        sql.SQL(target),
+                        using,
+                    )
+                )
+                print("Geometry type changed to", target)
+            geom_type = target
+
+        _load(
+            engine,
+            cursor,
+            chunk,
+            name,
+            schema,
+            ifexists if i == 0 else "append",
+            method,
+        )
+        conn.commit()
+
+        nb += len(chunk)
+        print("Chunk", i + 1, ":", nb, "rows imported")
+
+    _finalize_table(cursor, conn, name, schema, pk, idx_geom)
+
+    if close:
+        conn.close()
+
+
+def _drop_table(cursor, conn, name, schema):
+
+    try:
+
+        cursor.execute(
+            "select table_name from information_schema.tables where table_name = '{}' UNION select matviewname from pg_matviews where matviewname = '{}';".format(
+                name, name
+            )
+        )
+        cursor.fetchone()[0]
+
+        cursor.execute("DROP TABLE {}.{} CASCADE;".format(schema, name))
+        print("DROP TABLE")
+        conn.commit()
+
+    except TypeError:
+
+        pass
+
+
+def _load(engine, cursor, dat, name, schema, ifexists, method):
+
+    if method == "copy":
+        copy_data(cursor, dat, name, schema=schema, ifexists=ifexists)
+
+    elif isinstance(dat, gpd.GeoDataFrame):
         dat.to_postgis(
             name, engine, schema=schema, if_exists=ifexists
         )  # Add to postgis
@@ -68,7 +536,8 @@ def import_data(
             name, engine, schema=schema, if_exists=ifexists, index=False
         )  # Add to postgres
 
-    conn.commit()
+
+def _finalize_table(cursor, conn, name, schema, pk, idx_geom):
 
     if schema == None:
         table_name = name
@@ -98,46 +567,99 @@ def import_data(
         conn.commit()
     print("TABLE ", name, " WAS SUCESSFULLY IMPORTED")
 
-    conn.close()
 
-
-def insert_attribute(db, user, table_name, attr_name, attr_type, pk, data):
+def insert_attribute(
+    db, user, table_name, attr_name, attr_type, pk, data, session=None
+):
 
     """
     db: database name
     user: username
-    table_name: name of the table to modify
-    attr_name: name of the attribute to add
-    attr_type: type of the attribute to add (integer, text, etc.)
+    table_name: name of the table to modify (schema.table or table)
+    attr_name: name of the attribute to add (or list of attributes)
+    attr_type: type of the attribute to add (integer, text, etc.), or list of
+    types (one per attribute)
     pk: primary key
     data: dataframe having at least two attributes (one with the attriute to add, one with the primary key)
-    """
-
-    engine, conn, cursor = connect_db(db, user)
+    session: a GeosanDB session (reused connections), None to connect
 
-    try:
-        cursor.execute(f"ALTER TABLE {table_name} DROP COLUMN {attr_name};")
-        conn.commit()
-    except:
-        conn.rollback()
+    The values are copied (COPY) into a temporary table and all the rows are
+    updated with a single UPDATE ... FROM on the primary key. Missing values
+    (NaN) are inserted as NULL.
+    """
 
-    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {attr_name} {attr_type};")
-    conn.commit()
+    attr_names = [attr_name] if isinstance(attr_name, str) else list(attr_name)
+    attr_types = [attr_type] if isinstance(attr_type, str) else list(attr_type)
+    # Unquoted names are lower case in PostgreSQL
+    table = sql.Identifier(*table_name.lower().split("."))
+    tmp = sql.Identifier("tmp_insert_attribute")
+    db_pk = pk.lower()
+    db_names = [name.lower() for name in attr_names]
 
-    for i, value in enumerate(data[attr_name]):
+    engine, conn, cursor, close = _connect(db, user, session)
 
-        val = data.loc[i, pk]
+    for name, col_type in zip(db_names, attr_types):
+        try:
+            cursor.execute(
+                sql.SQL("ALTER TABLE {} DROP COLUMN {};").format(
+                    table, sql.Identifier(name))
+            )
+            conn.commit()
+        except:
+            conn.rollback()
 
         cursor.execute(
-            f"UPDATE {table_name} SET {attr_name} = '{value}' WHERE {pk} = {val}"
+            sql.SQL("ALTER TABLE {} ADD COLUMN {} {};").format(
+                table, sql.Identifier(name), sql.SQL(col_type))
         )
+        conn.commit()
 
-    conn.commit()
+    # Stage (pk, values) in a temporary table with the types of the table
+    columns = sql.SQL(", ").join(
+        sql.Identifier(col) for col in [db_pk] + db_names)
+    # pg_temp: never drop a permanent table with the same name
+    cursor.execute(
+        sql.SQL("DROP TABLE IF EXISTS {};").format(
+            sql.Identifier("pg_temp", "tmp_insert_attribute"))
+    )
+    cursor.execute(
+        sql.SQL(
+            "CREATE TEMP TABLE {} ON COMMIT DROP AS "
+            "SELECT {} FROM {} WITH NO DATA;"
+        ).format(tmp, columns, table)
+    )
+    _copy_chunk(
+        cursor,
+        data[[pk] + attr_names].set_axis([db_pk] + db_names, axis=1),
+        _copy_statement(cursor, tmp, [db_pk] + db_names),
+        _integer_columns(cursor, tmp),
+    )
 
-    cursor.execute(f"SELECT * FROM {table_name} WHERE {attr_name} IS NULL")
-    print(
-        "Check that everything was correctly inserted into DB: "
-        + str(len(cursor.fetchall()) == 0)
+    cursor.execute(
+        sql.SQL("UPDATE {} AS t SET {} FROM {} AS s WHERE t.{} = s.{};").format(
+            table,
+            sql.SQL(", ").join(
+                sql.SQL("{} = s.{}").format(
+                    sql.Identifier(name), sql.Identifier(name))
+                for name in db_names
+            ),
+            tmp,
+            sql.Identifier(db_pk),
+            sql.Identifier(db_pk),
+        )
     )
+    print("Number of updated rows :", cursor.rowcount)
+    conn.commit()
+
+    for name in db_names:
+        cursor.execute(
+            sql.SQL("SELECT COUNT(*) FROM {} WHERE {} IS NULL").format(
+                table, sql.Identifier(name))
+        )
+        print(
+            "Check that everything was correctly inserted into DB: "
+            + str(cursor.fetchone()[0] == 0)
+        )
 
-    conn.close()
+    if close:
+        conn.close()
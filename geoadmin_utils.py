@@ -0,0 +1,429 @@
+# geoadmin_utils.py
+
+import json
+import sqlite3
+import threading
+import time
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlsplit, parse_qsl
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+GEOADMIN_URL = "https://api3.geo.admin.ch/rest/services/api"
+
+
+# FUNCTION TO IDENTIFY A REQUEST TO THE API
+
+
+def request_key(path, params):
+    """
+    Normalized form of a request (path + sorted query parameters), used to
+    record / replay responses.
+    """
+
+    return path + "?" + urlencode(sorted((k, str(v)) for k, v in params.items()))
+
+
+# CLASS TO CACHE RESPONSES OF THE API ON DISK
+
+
+class ResponseCache:
+    """
+    Persistent cache (SQLite file) of the API responses, keyed by the
+    normalized request (see request_key). Responses older than ttl seconds
+    (30 days by default, None to keep them forever) are not returned. Only
+    successful responses (status 200) are cached.
+    """
+
+    def __init__(self, path, ttl=30 * 24 * 3600):
+
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, status INTEGER, content TEXT, created REAL)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        """Cached (status, content) of a request, None if not cached."""
+
+        with self._lock:
+            res = self.conn.execute(
+                "SELECT status, content, created FROM responses WHERE key=?",
+                (key,),
+            ).fetchone()
+
+        if res is None:
+            return None
+        if self.ttl is not None and time.time() - res[2] > self.ttl:
+            return None
+
+        return res[0], json.loads(res[1])
+
+    def put(self, key, status, content):
+
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, status, json.dumps(content), time.time()),
+            )
+            self.conn.commit()
+
+    def purge(self):
+        """Delete the expired responses."""
+
+        if self.ttl is None:
+            return 0
+
+        with self._lock:
+            cur = self.conn.execute(
+                "DELETE FROM responses WHERE created<?",
+                (time.time() - self.ttl,),
+            )
+            self.conn.commit()
+
+        return cur.rowcount
+
+    def close(self):
+
+        self.conn.close()
+
+
+# CLASS TO LIMIT THE NUMBER OF REQUESTS PER SECOND
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by threads: at most `rate` requests per
+    second on average, with bursts of at most `capacity` requests.
+    """
+
+    def __init__(self, rate=10, capacity=None):
+
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens +
+                    (now - self._last) * self.rate
+                )
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# CLIENT FOR GEOADMIN API (SEARCHSERVER / MAPSERVER)
+
+
+class GeoAdminClient:
+    """
+    Client for the geo.admin.ch API with a shared session (connection
+    pooling), rate limiting (token bucket), retries with exponential backoff
+    on errors (connection errors, 429 and 5xx responses) and concurrent batch
+    methods.
+
+    Inputs:
+    base_url = base URL of the API (e.g. the URL of a GeoAdminStubServer for
+    tests)
+    max_workers = number of concurrent requests in batch methods
+    rate = maximum number of requests per second
+    retries = number of retries of a failed request
+    backoff = waiting time (seconds) before the first retry, doubled at each
+    retry
+    timeout = request timeout (seconds)
+    record = should the responses be kept (see save_recordings)?
+    cache = a ResponseCache to reuse the responses of previous runs
+    offline = if True, responses only come from the cache (no request is
+    sent, requests that are not cached have no result: search returns the
+    label "Not in cache (offline)", handled as no match by get_coords)
+    """
+
+    def __init__(
+        self,
+        base_url=GEOADMIN_URL,
+        max_workers=4,
+        rate=10,
+        retries=3,
+        backoff=0.5,
+        timeout=10,
+        record=False,
+        cache=None,
+        offline=False,
+    ):
+
+        self.base_url = base_url.rstrip("/")
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = TokenBucket(rate)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.record = record
+        self.recordings = {}
+
+        self.cache = cache
+        self.offline = offline
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+    def close(self):
+
+        self.session.close()
+
+    def get(self, path, params):
+        """
+        Send a GET request to the API and return (status code, JSON content).
+        The JSON content is None if the response is not valid JSON. In
+        offline mode, requests that are not cached return (None, None).
+        """
+
+        key = request_key(path, params)
+        if self.cache is not None:
+            res = self.cache.get(key)
+            if res is not None:
+                return res
+        if self.offline is True:
+            return None, None
+
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(
+                    self.base_url + path, params=params, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+                if attempt == self.retries:
+                    break
+            time.sleep(self.backoff * 2 ** attempt)
+
+        try:
+            content = response.json()
+        except ValueError:
+            content = None
+
+        if self.record is True:
+            self.recordings[key] = {
+                "status": response.status_code,
+                "content": content,
+            }
+        if self.cache is not None and response.status_code == 200:
+            self.cache.put(key, response.status_code, content)
+
+        return response.status_code, content
+
+    def search(self, searchText):
+        """
+        Search an address in the buildings register (SearchServer). Returns
+        e, n, egid and label of the first result (see search_geoadmin).
+        """
+
+        status, content = self.get(
+            "/SearchServer",
+            {
+                "layer": "ch.bfs.gebaeude_wohnungs_register",
+                "searchText": searchText,
+                "type": "locations",
+                "origins": "address,zipcode",
+                "sr": "2056",
+            },
+        )
+
+        try:
+            res = content["results"][0]
+            e = res["attrs"]["y"]
+            n = res["attrs"]["x"]
+            egid = int(res["attrs"]["featureId"].split("_")[0])
+            label = res["attrs"]["label"]
+
+        except (IndexError, KeyError, TypeError):
+            e, n, egid = None, None, None
+            if status == 200:
+                label = "No match found"
+            elif status is None:
+                label = "Not in cache (offline)"
+            else:
+                label = "Error code" + str(status)
+
+        return e, n, egid, label
+
+    def find_egid(self, egid):
+        """
+        Street name and number (strname_deinr) of a building (MapServer/find
+        on egid).
+        """
+
+        status, content = self.get(
+            "/MapServer/find",
+            {
+                "layer": "ch.bfs.gebaeude_wohnungs_register",
+                "searchText": str(int(egid)),
+                "searchField": "egid",
+                "returnGeometry": "false",
+            },
+        )
+
+        try:
+            return content["results"][0]["attributes"]["strname_deinr"][0]
+        except Exception:
+            raise Exception("Sorry, egid not found")
+
+    def _map(self, func, items):
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as ex:
+            return list(ex.map(func, items))
+
+    def search_many(self, texts):
+        """search() for a list of addresses, concurrently (same order)."""
+
+        return self._map(self.search, texts)
+
+    def find_egids(self, egids):
+        """
+        find_egid() for a list of egids, concurrently (same order). Egids
+        that are not found give None.
+        """
+
+        def _find(egid):
+            try:
+                return self.find_egid(egid)
+            except Exception:
+                return None
+
+        return self._map(_find, egids)
+
+    def save_recordings(self, path):
+        """Save the recorded responses (JSON file for GeoAdminStubServer)."""
+
+        with open(path, "w") as f:
+            json.dump(self.recordings, f, indent=1)
+
+
+_default_client = None
+
+
+def default_client():
+    """Client shared by the geocoding functions when none is given."""
+
+    global _default_client
+    if _default_client is None:
+        _default_client = GeoAdminClient()
+
+    return _default_client
+
+
+def set_default_client(client):
+    """
+    Replace the client shared by the geocoding functions, e.g. to use a
+    ResponseCache or the offline mode in search_geoadmin / retrieve_egid_info:
+    set_default_client(GeoAdminClient(cache=ResponseCache("geoadmin.sqlite")))
+    """
+
+    global _default_client
+    _default_client = client
+
+
+# LOCAL SERVER REPLAYING RECORDED RESPONSES (FOR TESTS)
+
+
+class GeoAdminStubServer:
+    """
+    Local HTTP server replaying recorded responses of the API (see
+    GeoAdminClient.save_recordings), to test geocoding offline. Requests that
+    were not recorded get an empty list of results. The base URL to give to
+    GeoAdminClient is in the `url` attribute.
+
+    Usage:
+    with GeoAdminStubServer.from_file("recordings.json") as server:
+        client = GeoAdminClient(base_url=server.url)
+    """
+
+    def __init__(self, recordings=None, host="127.0.0.1", port=0):
+
+        self.recordings = {} if recordings is None else recordings
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+
+                url = urlsplit(self.path)
+                key = request_key(url.path, dict(parse_qsl(url.query)))
+                stub.requests.append(key)
+                res = stub.recordings.get(
+                    key, {"status": 200, "content": {"results": []}}
+                )
+
+                body = json.dumps(res["content"]).encode("utf-8")
+                self.send_response(res["status"])
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = "http://{}:{}".format(*self.server.server_address)
+        self._thread = None
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+
+        with open(path) as f:
+            return cls(json.load(f), **kwargs)
+
+    def start(self):
+
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.stop()
@@ -4,12 +4,23 @@ import unicodedata
 import numpy as np
 import re
 import difflib
+import bisect
+import functools
+import concurrent.futures
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+import weakref
+from collections import Counter, OrderedDict, defaultdict
 import pandas as pd
 import math
-import requests
-import time
 import psycopg2 as ps
 
+import geoadmin_utils as ga
+
 # FUNCTION TO REMOVE ACCENTS ON STRING
 
 
@@ -28,6 +39,9 @@ def strip_accents(text):
 
 # FUNCTION TO EXTRACT THE STREET NUMBER / STREET NAME FROM AN ADDRESS
 
+_number_first = re.compile("(\d+).*?\s+(.+)")
+_number_last = re.compile("(?<=[a-zA-Z-zÀ-ÿ])\\s*(?=[0-9])")
+
 
 def split_address(x):
     """
@@ -49,7 +63,7 @@ def split_address(x):
         # Address in the form: 20 avenue longchamps
         if x[0].isdigit():
 
-            split = re.split("(\d+).*?\s+(.+)", x)
+            split = _number_first.split(x)
             split_len = len(split)
 
             # With this pattern, the first and last element of the list are
@@ -59,7 +73,7 @@ def split_address(x):
 
         # Address in the form: Avenue longchamps 20
         else:
-            split = re.split("(?<=[a-zA-Z-zÀ-ÿ])\\s*(?=[0-9])", x)
+            split = _number_last.split(x)
             split_len = len(split)
 
             if split_len == 1:
@@ -77,6 +91,86 @@ def split_address(x):
     return deinr, strname
 
 
+# FUNCTION TO NORMALIZE A SERIES OF ADDRESSES
+
+# Translation table to remove accents (filled with the characters met)
+_accents = {}
+
+
+def _strip_accents_upper(x):
+
+    if not isinstance(x, str):
+        return x
+
+    for ch in x:
+        if ord(ch) > 127 and ord(ch) not in _accents:
+            _accents[ord(ch)] = strip_accents(ch)
+
+    return x.translate(_accents).upper()
+
+
+def normalize_addresses(addresses, split=False, remove_typo=False):
+    """
+    Normalize a whole series of addresses (or street / municipality names):
+    accents are removed and text is converted into upper case, like
+    strip_accents followed by str.upper. If split=True, addresses are then
+    split into street number and street name (see split_address) and the
+    function returns a dataframe with the columns deinr and strname. If
+    remove_typo=True, street types are removed from the street names (see
+    remove_typo_addr). Each distinct value is processed only once, with a
+    translation table and precompiled patterns, and the results are broadcast
+    back to the series. Values that are not strings (e.g. NaN) are left as is.
+    """
+
+    codes, uniques = pd.factorize(addresses, use_na_sentinel=False)
+    uniques = [_strip_accents_upper(x) for x in uniques]
+
+    if split is True:
+        parts = [split_address(x) for x in uniques]
+        deinr = [part[0] for part in parts]
+        strname = [part[1] for part in parts]
+    else:
+        strname = uniques
+
+    if remove_typo is True:
+        strname = [
+            remove_typo_addr(x) if isinstance(x, str) else x for x in strname
+        ]
+
+    strname = pd.Series(
+        np.array(strname, dtype=object)[codes], index=addresses.index,
+        name=addresses.name,
+    )
+
+    if split is True:
+        return pd.DataFrame(
+            {
+                "deinr": np.array(deinr, dtype=object)[codes],
+                "strname": strname.values,
+            },
+            index=addresses.index,
+        )
+
+    return strname
+
+
+def _number_key(deinr):
+    """Street number as a string, as in RegBL (12 or 12.0 become "12")."""
+
+    if isinstance(deinr, (int, np.integer)) or (
+        isinstance(deinr, float) and deinr.is_integer()
+    ):
+        return str(int(deinr))
+
+    return deinr
+
+
+def _number_keys(deinr):
+    """_number_key on a whole series of street numbers."""
+
+    return deinr.map(_number_key).astype(object)
+
+
 # FUNCTION TO PREPARE REGBL FOR GEOCODING
 
 
@@ -96,13 +190,9 @@ def regbl_wrangling(regbl_dat):
     regbl_dat = regbl_dat[~regbl_dat.strname.isna()]
     print("Missing addresses were removed from the dataset.")
 
-    # Remove accents
-    regbl_dat["strname"] = regbl_dat.strname.map(strip_accents)
-    regbl_dat["gdename"] = regbl_dat.gdename.map(strip_accents)
-
-    # Convert street and municipality into upper case
-    regbl_dat["strname"] = regbl_dat.strname.map(str.upper)
-    regbl_dat["gdename"] = regbl_dat.gdename.map(str.upper)
+    # Remove accents and convert street and municipality into upper case
+    regbl_dat["strname"] = normalize_addresses(regbl_dat.strname)
+    regbl_dat["gdename"] = normalize_addresses(regbl_dat.gdename)
 
     # Select only essential columns
     regbl_dat = regbl_dat[
@@ -112,10 +202,1219 @@ def regbl_wrangling(regbl_dat):
     return regbl_dat
 
 
+# CLASS TO CACHE FUZZY MATCHES OF STREET NAMES
+
+
+class FuzzyMatchCache:
+    """
+    Bounded LRU cache of fuzzy street matches, shared by all the geocoding
+    helpers (through FuzzyStreetIndex). Entries are keyed by (locality, street
+    name, cutoff), where the locality is identified by a digest of its
+    candidate street names, so that the same misspelled street is matched
+    only once. If a path is given, the cache is loaded from it (if the file
+    exists) and can be saved to it with save() to be reused in the next runs.
+    """
+
+    def __init__(self, maxsize=100000, path=None):
+
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def get(self, key):
+        """Return (True, match) if the key is cached, (False, None) if not."""
+
+        try:
+            match = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return True, match
+
+    def put(self, key, match):
+
+        self._entries[key] = match
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """Hit / miss statistics of the cache."""
+
+        calls = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / calls, 4) if calls > 0 else None,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, path=None):
+
+        path = self.path if path is None else path
+        with open(path, "wb") as f:
+            pickle.dump(list(self._entries.items()), f)
+
+    def load(self, path=None):
+
+        path = self.path if path is None else path
+        with open(path, "rb") as f:
+            for key, match in pickle.load(f):
+                self.put(key, match)
+
+
+fuzzy_cache = FuzzyMatchCache()
+
+
+# CLASS FOR FUZZY MATCHING OF STREET NAMES
+
+
+def _street_key(text):
+    """Street name without accents, in upper case and without extra spaces
+    (compared by FuzzyStreetIndex)."""
+
+    if not isinstance(text, str):
+        return text
+
+    return " ".join(_strip_accents_upper(text).split())
+
+
+class FuzzyStreetIndex:
+    """
+    Candidate index over a list of street names (e.g. the streets of a
+    locality) to find the closest street name to a given one. The result is
+    the same as difflib.get_close_matches(word, streets, 1, cutoff) on the
+    normalized names (without accents, in upper case and without extra
+    spaces, see _street_key), but instead of scoring every street, the
+    character counts of the streets are precomputed (1-gram vectors). They
+    give an upper bound of the difflib ratio for all streets at once, so that
+    only the few streets that can reach the cutoff are scored with difflib,
+    best bound first. The original name of the closest street is returned. Matches are stored in a FuzzyMatchCache (cache=None for the
+    shared fuzzy_cache, looked up at each call so that it can be replaced,
+    False to disable caching).
+    """
+
+    def __init__(self, streets, cache=None):
+
+        self.streets = list(dict.fromkeys(streets))
+        self._cache = cache
+
+        # Normalized names, and the first street with each of them
+        self._original = {}
+        for s in self.streets:
+            self._original.setdefault(_street_key(s), s)
+        self._names = list(self._original)
+
+        self.digest = hashlib.sha1(
+            repr(sorted(self._names)).encode("utf-8")
+        ).hexdigest()
+        self._lengths = np.array([len(s) for s in self._names], dtype=int)
+
+        self._chars = {}
+        for s in self._names:
+            for ch in s:
+                self._chars.setdefault(ch, len(self._chars))
+
+        self._counts = np.zeros(
+            (len(self._names), len(self._chars)), dtype=np.int32)
+        for i, s in enumerate(self._names):
+            for ch, k in Counter(s).items():
+                self._counts[i, self._chars[ch]] = k
+
+    @property
+    def cache(self):
+        """FuzzyMatchCache used by best_match (None if disabled)."""
+
+        if self._cache is None:
+            return fuzzy_cache
+        if self._cache is False:
+            return None
+
+        return self._cache
+
+    def best_match(self, word, cutoff=0.6):
+        """
+        Closest street name to word (difflib ratio >= cutoff, ties broken as
+        in difflib) or None if no street is close enough.
+        """
+
+        if not 0.0 <= cutoff <= 1.0:
+            raise ValueError("cutoff must be in [0.0, 1.0]: %r" % (cutoff,))
+
+        word = _street_key(word)
+        cache = self.cache
+        found = False
+        if cache is not None:
+            found, match = cache.get((self.digest, word, cutoff))
+        if not found:
+            match = self._best_match(word, cutoff)
+            if cache is not None:
+                cache.put((self.digest, word, cutoff), match)
+
+        if match is None:
+            return None
+
+        return self._original.get(match, match)
+
+    def _best_match(self, word, cutoff):
+
+        total = self._lengths + len(word)
+        query = np.zeros(len(self._chars), dtype=np.int32)
+        for ch, k in Counter(word).items():
+            if ch in self._chars:
+                query[self._chars[ch]] = k
+
+        # Same as SequenceMatcher.quick_ratio for all streets
+        matches = np.minimum(self._counts, query).sum(axis=1)
+        bound = np.where(total > 0, 2.0 * matches / np.maximum(total, 1), 1.0)
+
+        candidates = np.flatnonzero(bound >= cutoff)
+        candidates = candidates[np.argsort(-bound[candidates], kind="stable")]
+
+        s = difflib.SequenceMatcher()
+        s.set_seq2(word)
+        best = None
+        for i in candidates:
+            if best is not None and bound[i] < best[0]:
+                break
+            s.set_seq1(self._names[i])
+            score = s.ratio()
+            if score >= cutoff and (
+                best is None or (score, self._names[i]) > best
+            ):
+                best = (score, self._names[i])
+
+        if best is None:
+            return None
+
+        return best[1]
+
+
+@functools.lru_cache(maxsize=256)
+def _fuzzy_index(possibilities):
+
+    return FuzzyStreetIndex(possibilities)
+
+
+def get_close_matches(word, possibilities, n=1, cutoff=0.6):
+    """
+    Drop-in replacement for difflib.get_close_matches. For the best match only
+    (n=1), a FuzzyStreetIndex is built once for each list of possibilities
+    and reused for the next calls with the same list (names are then compared
+    without accents, case and extra spaces).
+    """
+
+    if n != 1:
+        return difflib.get_close_matches(word, possibilities, n, cutoff)
+
+    match = _fuzzy_index(tuple(possibilities)).best_match(word, cutoff)
+    if match is None:
+        return []
+
+    return [match]
+
+
+# CLASS TO FIND THE CLOSEST STREET NUMBER IN A STREET
+
+_digits = re.compile("\d+")
+_number_suffix = re.compile("^(\d+)[a-zA-Z]")
+
+
+class StreetNumbers:
+    """
+    Street numbers of the addresses of a street, to find the closest street
+    number to a given one (search_regbl with closest_num=True) by binary
+    search. The numeric part of the street numbers is sorted once, and the
+    addresses are stored by street number and by numeric part of the
+    suffixed street numbers (e.g. 12a, 12b -> 12).
+
+    Inputs:
+    deinr = array of the street numbers of RegBL
+    positions = positions (in frame order) of the addresses of the street
+    """
+
+    def __init__(self, deinr, positions):
+
+        self.positions = positions
+        self._deinr = deinr
+        self.list_no = [deinr[p] for p in positions if not pd.isnull(deinr[p])]
+
+        self.by_deinr = {}
+        self.by_number = {}
+        for p in positions:
+            x = deinr[p]
+            if not isinstance(x, str):
+                continue
+            self.by_deinr.setdefault(x, []).append(p)
+            suffix = _number_suffix.match(x)
+            if suffix is not None:
+                self.by_number.setdefault(suffix.group(1), []).append(p)
+
+        # Same errors as re.findall on the street numbers (see search_regbl)
+        self.error = None
+        self.values = []
+        self.ranks = []
+        try:
+            numbers = [float(_digits.findall(x)[0]) for x in self.list_no]
+        except (IndexError, TypeError) as err:
+            self.error = err
+            return
+
+        # Distinct numbers (sorted) and rank of their first occurrence
+        first = {}
+        for rank, x in enumerate(numbers):
+            first.setdefault(x, rank)
+        self.values = sorted(first)
+        self.ranks = [first[x] for x in self.values]
+
+    def closest(self, deinr):
+        """
+        Closest street number to deinr (first one in frame order if two are
+        as close). Raises ValueError if there is no street number.
+        """
+
+        if isinstance(self.error, TypeError):
+            raise TypeError(self.error)
+        if isinstance(self.error, IndexError):
+            # if list of deinr ony contains letters
+            return self.list_no[0]
+        if not self.values:
+            raise ValueError("min() arg is an empty sequence")
+
+        try:
+            target = float(_digits.findall(deinr)[0])
+        except IndexError:
+            # Street numbers (converted into numbers) are kept
+            return self.values[self.ranks.index(0)]
+
+        i = bisect.bisect_left(self.values, target)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(self.values)]
+        best = min(
+            candidates,
+            key=lambda j: (abs(self.values[j] - target), self.ranks[j]),
+        )
+
+        return str(int(self.values[best]))
+
+    def matches(self, closest):
+        """
+        Positions of the addresses with the street number closest, or with
+        a suffixed street number (e.g. 12a for 12) if there is none.
+        """
+
+        if isinstance(closest, str) and closest.isdecimal():
+            matches = self.by_deinr.get(closest, [])
+            if not matches:
+                matches = self.by_number.get(closest, [])
+            return matches
+
+        matches = [p for p in self.positions if self._deinr[p] == closest]
+        if not matches:
+            pattern = re.compile("^" + closest + "[a-zA-Z]")
+            matches = [
+                p
+                for p in self.positions
+                if isinstance(self._deinr[p], str)
+                and pattern.search(self._deinr[p])
+            ]
+
+        return matches
+
+
+# CLASS TO INDEX REGBL ADDRESSES FOR GEOCODING
+
+
+def _first_notypo(regbl_dat):
+    """First street name of RegBL for each street name without typo."""
+
+    notypo = regbl_dat.strname.map(remove_typo_addr).values
+    first = ~pd.Series(notypo).duplicated().values
+
+    return dict(zip(notypo[first], regbl_dat.strname.values[first]))
+
+
+class RegBLIndex:
+    """
+    Prebuilt lookup structure over a RegBL dataframe (see regbl_wrangling).
+    Instead of scanning the whole address table with boolean masks for every
+    search, addresses are hashed once by (locality, street) and by (locality,
+    street, street number), both with the postal code (dplz4) and with the
+    municipality name (gdename) as locality. Exact lookups are thus O(1).
+    The index can be given to search_regbl / get_coords in place of the RegBL
+    dataframe and returns the same matches.
+    """
+
+    def __init__(self, regbl_dat):
+
+        self.regbl = regbl_dat
+
+        self._egid = regbl_dat.egid.values
+        self._gkode = regbl_dat.gkode.values
+        self._gkodn = regbl_dat.gkodn.values
+        self._strname = regbl_dat.strname.values
+        self._deinr = regbl_dat.deinr.values
+
+        self._npas = set(regbl_dat.dplz4.dropna().unique())
+
+        # Positions (in frame order) of the addresses of each street
+        self._streets = {}
+        # Position of the first address for each street number
+        self._buildings = {}
+        # Street names of each locality (for fuzzy matching)
+        self._locality_streets = {}
+
+        for mode, col in (("npa", "dplz4"), ("gdename", "gdename")):
+            keys = regbl_dat[[col, "strname"]].reset_index(drop=True)
+            self._streets[mode] = keys.groupby(
+                [col, "strname"], sort=False).indices
+
+            locality_streets = {}
+            for locality, strname in self._streets[mode]:
+                locality_streets.setdefault(locality, []).append(strname)
+            self._locality_streets[mode] = locality_streets
+
+            keys["deinr"] = self._deinr
+            keys = keys[~keys.isna().any(axis=1)]
+            first = ~keys.duplicated()
+            self._buildings[mode] = dict(
+                zip(
+                    zip(
+                        keys[col].values[first.values],
+                        keys.strname.values[first.values],
+                        keys.deinr.values[first.values],
+                    ),
+                    keys.index.values[first.values],
+                )
+            )
+
+        # First street name (whole RegBL) for each street name without typo
+        self._notypo_first = _first_notypo(regbl_dat)
+
+        # Fuzzy street indexes of each locality (built when needed)
+        self._fuzzy = {}
+
+        # Street numbers of each street (built when needed)
+        self._numbers = {}
+
+        # First address (sorted by street number) of each street
+        self._first_on_street = {}
+
+        self._version = None
+
+    @property
+    def version(self):
+        """Tag identifying the content of the indexed RegBL."""
+
+        if self._version is None:
+            self._version = regbl_version(self.regbl)
+
+        return self._version
+
+    def has_npa(self, npa):
+        """Is the postal code present in RegBL?"""
+        try:
+            return npa in self._npas
+        except TypeError:
+            return False
+
+    def _locality(self, row, use_npa):
+
+        if use_npa is True:
+            return "npa", row.npa
+        else:
+            return "gdename", row.ville
+
+    def _street_positions(self, mode, locality, strname):
+
+        try:
+            return self._streets[mode].get((locality, strname), [])
+        except TypeError:
+            return []
+
+    def _first_sorted(self, positions):
+        """Position of the first address once sorted by street number."""
+
+        if len(positions) == 1:
+            return positions[0]
+
+        return (
+            pd.Series(self._deinr[positions], index=positions)
+            .sort_values()
+            .index[0]
+        )
+
+    def fuzzy_index(self, mode, locality, notypo=False):
+        """
+        FuzzyStreetIndex of the street names of a locality (without typo if
+        notypo=True, see remove_typo_addr).
+        """
+
+        key = (mode, locality, notypo)
+        if key not in self._fuzzy:
+            try:
+                streets = self._locality_streets[mode].get(locality, [])
+            except TypeError:
+                streets = []
+            if notypo is True:
+                streets = [remove_typo_addr(s) for s in streets]
+            self._fuzzy[key] = FuzzyStreetIndex(streets)
+
+        return self._fuzzy[key]
+
+    def fuzzy_street(self, row, use_npa=True, fuzzy_level=0.9):
+        """
+        Closest street name (difflib) in the row's locality, first on the
+        raw street names and then on street names without typo (see
+        remove_typo_addr). Returns None if no street is close enough.
+        """
+
+        mode, locality = self._locality(row, use_npa)
+
+        match = self.fuzzy_index(mode, locality).best_match(
+            row.strname, fuzzy_level)
+        if match is not None:
+            return match
+
+        match = self.fuzzy_index(mode, locality, notypo=True).best_match(
+            remove_typo_addr(row.strname), fuzzy_level
+        )
+        if match is not None:
+            return self._notypo_first[match]
+
+        return None
+
+    def street_numbers(self, mode, locality, strname):
+        """StreetNumbers of a street (built when needed)."""
+
+        key = (mode, locality, strname)
+        if key not in self._numbers:
+            self._numbers[key] = StreetNumbers(
+                self._deinr,
+                self._street_positions(mode, locality, strname),
+            )
+
+        return self._numbers[key]
+
+    def building_table(self, mode="npa"):
+        """
+        Dataframe (locality, strname, deinr, _pos) with the position of the
+        first address for each street number, to join a whole dataset at once
+        (mode "npa" for dplz4 and "gdename" for municipality names).
+        """
+
+        table = pd.DataFrame(
+            list(self._buildings[mode].keys()),
+            columns=["locality", "strname", "deinr"],
+        )
+        table["_pos"] = list(self._buildings[mode].values())
+
+        return table
+
+    def street_table(self, mode="npa"):
+        """
+        Dataframe (locality, strname, _pos) with the position of the first
+        address (sorted by street number) of each street, same as
+        search(on="street") but for all streets at once.
+        """
+
+        col = "dplz4" if mode == "npa" else "gdename"
+        streets = pd.DataFrame(
+            {
+                "locality": self.regbl[col].values,
+                "strname": self._strname,
+                "deinr": self._deinr,
+                "_pos": np.arange(len(self._strname)),
+            }
+        ).dropna(subset=["locality", "strname"])
+
+        streets = streets.sort_values(
+            ["locality", "strname", "deinr"], kind="mergesort")
+        ties = streets.duplicated(
+            ["locality", "strname", "deinr"], keep=False
+        ) & ~streets.deinr.isna()
+        first = ~streets.duplicated(["locality", "strname"])
+        table = streets.loc[first, ["locality", "strname", "_pos"]]
+
+        # Several addresses with the same (lowest) street number: use the same
+        # sort as search() to pick the first one
+        for i in np.flatnonzero(ties[first].values):
+            locality, strname = table.iloc[i, 0], table.iloc[i, 1]
+            table.iloc[i, 2] = self._first_sorted(
+                self._streets[mode][(locality, strname)]
+            )
+
+        return table.reset_index(drop=True)
+
+    def search(
+        self,
+        row,
+        on="building",
+        use_npa=True,
+        fuzzy_rue=True,
+        closest_num=False,
+        fuzzy_level=0.9,
+    ):
+        """Same as search_regbl, using the index (see search_regbl)."""
+
+        mode, row_locality = self._locality(row, use_npa)
+
+        if fuzzy_rue is True:
+            row_streetname = self.fuzzy_street(row, use_npa, fuzzy_level)
+            if row_streetname is None:
+                return None, None, None
+        else:
+            row_streetname = row.strname
+
+        positions = self._street_positions(mode, row_locality, row_streetname)
+        match = None
+
+        if on == "street":
+            if closest_num is True:
+                numbers = self.street_numbers(
+                    mode, row_locality, row_streetname)
+                matches = numbers.matches(numbers.closest(row.deinr))
+                if matches:
+                    match = self._first_sorted(matches)
+            elif len(positions) > 0:
+                key = (mode, row_locality, row_streetname)
+                if key not in self._first_on_street:
+                    self._first_on_street[key] = self._first_sorted(positions)
+                match = self._first_on_street[key]
+
+        elif on == "building":
+            try:
+                match = self._buildings[mode].get(
+                    (row_locality, row_streetname, row.deinr)
+                )
+            except TypeError:
+                match = None
+
+        if match is None:
+            return None, None, None
+
+        return self._gkode[match], self._gkodn[match], self._egid[match]
+
+
+# FUNCTIONS TO GEOCODE EACH DISTINCT ADDRESS ONCE
+
+
+def _address_keys(df, cols):
+    """
+    Normalized address fields, compared and geocoded by dedupe_addresses:
+    text without extra spaces (and without accents, in upper case, except
+    street numbers), street numbers as text (12 or 12.0 give "12") and other
+    integral numbers as integers (1000.0 gives 1000).
+    """
+
+    keys = pd.DataFrame(index=df.index)
+    for col in cols:
+        if col == "deinr":
+            values = _number_keys(df[col])
+        else:
+            values = df[col].map(
+                lambda x: int(x)
+                if isinstance(x, float) and x.is_integer()
+                else x
+            ).astype(object)
+        values = values.map(
+            lambda x: " ".join(x.split()) if isinstance(x, str) else x
+        )
+        # Street numbers keep their case, as in RegBL (12a)
+        keys[col] = values if col == "deinr" else normalize_addresses(values)
+
+    return keys
+
+
+def dedupe_addresses(df, cols=("strname", "deinr", "npa", "ville")):
+    """
+    Identify the distinct addresses of a dataset of individuals, after
+    normalization of the address fields (see _address_keys). Each address
+    gets an identifier init_addr (hash of the normalized fields, unless df
+    already has an init_addr column). Returns the distinct addresses (one row
+    per init_addr, with the normalized fields, so that the result does not
+    depend on the order of the rows) and a copy of df with the init_addr
+    column, which can be used as df_for_stats in remove_subset.
+    """
+
+    df = df.copy()
+    cols = list(cols)
+    keys = _address_keys(df, cols)
+    if "init_addr" not in df.columns:
+        df["init_addr"] = pd.util.hash_pandas_object(keys, index=False).values
+    keys["init_addr"] = df["init_addr"]
+
+    addresses = keys.drop_duplicates("init_addr")[["init_addr"] + cols]
+    addresses = addresses.reset_index(drop=True)
+
+    print("Number of individuals: ", df.shape[0])
+    print(
+        "Number of distinct addresses: ",
+        addresses.shape[0],
+        "(",
+        round(addresses.shape[0] * 100 / df.shape[0], 2)
+        if df.shape[0] > 0 else 0,
+        "%)",
+    )
+    if addresses.shape[0] > 0:
+        print(
+            "Deduplication ratio (individuals per address): ",
+            round(df.shape[0] / addresses.shape[0], 2),
+        )
+    print()
+
+    return addresses, df
+
+
+def geocode_unique(
+    df,
+    regbl,
+    npa,
+    level=0.9,
+    n_jobs=1,
+    cols=("strname", "deinr", "npa", "ville"),
+    cache=None,
+):
+    """
+    Geocode each distinct address of a dataset of individuals only once
+    (geocode_batch, or geocode_parallel if n_jobs > 1, with the optional
+    GeocodingCache) and join the results back to all the individuals.
+
+    Outputs:
+    addresses = distinct addresses (init_addr + address fields) with the
+    columns e, n, egid, note_geocoding and case
+    indivs = df with the init_addr column and the geocoding columns
+
+    Statistics on individuals can then be computed while cleaning addresses:
+    remove_subset(addresses, subset, label, indivs.shape[0],
+    df_for_stats=indivs[["init_addr"]])
+    """
+
+    addresses, indivs = dedupe_addresses(df, cols)
+
+    if n_jobs == 1:
+        res = geocode_batch(addresses, regbl, npa, level, cache=cache)
+    else:
+        res = geocode_parallel(
+            addresses, regbl, npa, level, n_jobs=n_jobs, cache=cache)
+    addresses = pd.concat([addresses, res], axis=1)
+
+    indivs = indivs.join(
+        addresses.set_index("init_addr")[list(res.columns)], on="init_addr"
+    )
+
+    return addresses, indivs
+
+
+# FUNCTION TO GEOCODE LARGE FILES BY CHUNKS
+
+
+def geocode_csv(
+    input_path,
+    output_path,
+    regbl,
+    npa,
+    level=0.9,
+    chunksize=10000,
+    n_jobs=1,
+    checkpoint_path=None,
+    cache=None,
+    **read_kwargs
+):
+    """
+    Geocode a CSV file of addresses (columns strname, deinr, npa, ville) by
+    chunks of chunksize rows, so that memory does not depend on the size of
+    the file. The geocoding results (e, n, egid, note_geocoding, case) of each
+    chunk are appended to the output file as soon as the chunk is done: a
+    CSV file, or a directory of Parquet files (one per chunk) if output_path
+    ends with ".parquet". A checkpoint (JSON file, output_path +
+    ".checkpoint.json" by default) records the chunks written, and running
+    the function again resumes after the last completed chunk (with the same
+    input_path and chunksize). Additional arguments are given to
+    pandas.read_csv, except skiprows (used to resume); the columns strname,
+    deinr and ville are always read as strings, so that all the chunks have
+    the same types. cache is an optional GeocodingCache (see geocode_batch),
+    to reuse the results of previous runs.
+    """
+
+    if not isinstance(regbl, RegBLIndex):
+        regbl = RegBLIndex(regbl)
+    if not isinstance(npa, NPACentroids):
+        npa = NPACentroids(npa)
+
+    if "skiprows" in read_kwargs:
+        raise ValueError("skiprows is not supported (used to resume)")
+
+    # Same types in every chunk, whatever the values of the chunk
+    dtype = read_kwargs.pop("dtype", None)
+    if dtype is None or isinstance(dtype, dict):
+        dtype = dict(dtype or {}, strname=str, deinr=str, ville=str)
+
+    parquet = output_path.endswith(".parquet")
+    if checkpoint_path is None:
+        checkpoint_path = output_path + ".checkpoint.json"
+
+    start = {
+        "input_path": os.path.abspath(input_path),
+        "chunksize": chunksize,
+        "chunks": 0,
+        "rows": 0,
+        "bytes": 0,
+    }
+
+    # Resume after the last completed chunk
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if (checkpoint.get("input_path"), checkpoint.get("chunksize")) != (
+            start["input_path"],
+            chunksize,
+        ):
+            raise ValueError(
+                "Checkpoint {} was written for {} (chunksize {})".format(
+                    checkpoint_path,
+                    checkpoint.get("input_path"),
+                    checkpoint.get("chunksize"),
+                )
+            )
+
+        # Output missing or shorter than recorded: start again
+        if parquet:
+            complete = all(
+                os.path.exists(
+                    os.path.join(output_path, "part-{:05d}.parquet".format(i))
+                )
+                for i in range(checkpoint["chunks"])
+            )
+        else:
+            complete = (
+                os.path.exists(output_path)
+                and os.path.getsize(output_path) >= checkpoint["bytes"]
+            )
+        if complete:
+            print("Resume after chunk", checkpoint["chunks"],
+                  "(", checkpoint["rows"], "rows )")
+        else:
+            print("Output incomplete, geocode from the first chunk")
+            checkpoint = dict(start)
+    else:
+        checkpoint = dict(start)
+
+    if parquet:
+        os.makedirs(output_path, exist_ok=True)
+        # Remove parts written after the checkpoint (interrupted chunk)
+        for name in os.listdir(output_path):
+            if name.startswith("part-") and int(
+                name[len("part-"):].split(".")[0]
+            ) >= checkpoint["chunks"]:
+                os.remove(os.path.join(output_path, name))
+    else:
+        # Remove rows written after the checkpoint (interrupted chunk)
+        with open(output_path, "a") as f:
+            f.truncate(checkpoint["bytes"])
+
+    chunks = pd.read_csv(
+        input_path,
+        chunksize=chunksize,
+        skiprows=range(1, checkpoint["rows"] + 1),
+        dtype=dtype,
+        **read_kwargs
+    )
+
+    for chunk in chunks:
+        # Nothing left to geocode (e.g. rerun after the last chunk)
+        if chunk.shape[0] == 0:
+            continue
+
+        if n_jobs == 1:
+            res = geocode_batch(chunk, regbl, npa, level, cache=cache)
+        else:
+            res = geocode_parallel(
+                chunk, regbl, npa, level, n_jobs=n_jobs, cache=cache)
+        chunk = pd.concat([chunk, res], axis=1)
+
+        if parquet:
+            chunk.to_parquet(
+                os.path.join(
+                    output_path, "part-{:05d}.parquet".format(
+                        checkpoint["chunks"])
+                ),
+                index=False,
+            )
+        else:
+            with open(output_path, "a", newline="") as f:
+                chunk.to_csv(f, index=False, header=checkpoint["bytes"] == 0)
+                f.flush()
+                os.fsync(f.fileno())
+                checkpoint["bytes"] = f.tell()
+
+        if cache is not None:
+            cache.commit()
+        checkpoint["chunks"] += 1
+        checkpoint["rows"] += chunk.shape[0]
+        with open(checkpoint_path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+        print("Chunk", checkpoint["chunks"], "geocoded (",
+              checkpoint["rows"], "rows )")
+
+    return checkpoint["rows"]
+
+
+# FUNCTIONS TO CACHE GEOCODING RESULTS ON DISK
+
+
+def regbl_version(regbl_dat):
+    """
+    Tag identifying the content of a RegBL dataframe (or RegBLIndex), to
+    invalidate geocoding results obtained with another version of RegBL.
+    """
+
+    if isinstance(regbl_dat, RegBLIndex):
+        return regbl_dat.version
+
+    hashes = pd.util.hash_pandas_object(
+        regbl_dat[["egid", "strname", "deinr", "dplz4", "gdename", "gkode",
+                   "gkodn"]],
+        index=False,
+    )
+
+    return hashlib.sha1(hashes.values.tobytes()).hexdigest()[:16]
+
+
+def npa_version(npa):
+    """
+    Tag identifying the content of a dataframe of NPA centroids (or
+    NPACentroids), same as regbl_version.
+    """
+
+    if isinstance(npa, NPACentroids):
+        return npa.version
+
+    hashes = pd.util.hash_pandas_object(
+        npa[["Ortschaftsname", "PLZ", "E", "N"]], index=False)
+
+    return hashlib.sha1(hashes.values.tobytes()).hexdigest()[:16]
+
+
+class GeocodingCache:
+    """
+    Persistent cache (SQLite file) of the results of get_coords, keyed by the
+    address (strname, deinr, npa, ville, as given to get_coords: missing
+    values, empty strings and types are kept apart, except numeric street
+    numbers, searched as text), the fuzzy level and the version of the
+    tables used for the lookup (see regbl_version and npa_version, plus the
+    optional version tag). Results obtained with other tables are never
+    returned and can be deleted with invalidate(). The cache can be given to
+    get_coords, geocode_batch, geocode_parallel, geocode_unique and
+    geocode_csv.
+
+    Usage:
+    cache = GeocodingCache("geocoding_cache.sqlite")
+    res = geocode_batch(df, regbl, npa, 0.9, cache=cache)
+    cache.close()
+    """
+
+    def __init__(self, path, version=None, commit_every=1000):
+
+        self.path = path
+        self.version = version
+        self.commit_every = commit_every
+        self._pending = 0
+        # Tables of the last lookup (weak references) and their version
+        self._tables = None
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocoding ("
+            "version TEXT, strname TEXT, deinr TEXT, npa TEXT, ville TEXT, "
+            "level REAL, result TEXT, "
+            "PRIMARY KEY (version, strname, deinr, npa, ville, level))"
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+    @staticmethod
+    def _encode(x):
+
+        if x is None or x is pd.NA or (
+            isinstance(x, (float, np.floating)) and math.isnan(x)
+        ):
+            return "null:"
+        if isinstance(x, str):
+            return "str:" + x
+        if isinstance(x, (int, np.integer)):
+            return "int:" + str(int(x))
+        if isinstance(x, (float, np.floating)):
+            return "float:" + repr(float(x))
+
+        return type(x).__name__ + ":" + str(x)
+
+    def tables_version(self, regbl, npa):
+        """Version of the RegBL and NPA tables (and of the version tag)."""
+
+        if self._tables is not None:
+            regbl_ref, npa_ref, version = self._tables
+            if regbl_ref() is regbl and npa_ref() is npa:
+                return version
+
+        version = regbl_version(regbl) + "-" + npa_version(npa)
+        if self.version is not None:
+            version += "-" + str(self.version)
+        self._tables = (weakref.ref(regbl), weakref.ref(npa), version)
+
+        return version
+
+    def key(self, row, level, regbl, npa):
+        """
+        Key of an address (row with strname, deinr, npa, ville) geocoded with
+        the given RegBL and NPA tables.
+        """
+
+        return (
+            self.tables_version(regbl, npa),
+            self._encode(row.strname),
+            self._encode(_number_key(row.deinr)),
+            self._encode(row.npa),
+            self._encode(row.ville),
+            float(level),
+        )
+
+    def get(self, key):
+        """Cached result of get_coords for the key (None if not cached)."""
+
+        res = self.conn.execute(
+            "SELECT result FROM geocoding WHERE version=? AND strname=? AND "
+            "deinr=? AND npa=? AND ville=? AND level=?",
+            key,
+        ).fetchone()
+
+        if res is None:
+            return None
+
+        return tuple(json.loads(res[0]))
+
+    def put(self, key, result):
+
+        result = [x.item() if isinstance(x, np.generic) else x for x in result]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO geocoding VALUES (?, ?, ?, ?, ?, ?, ?)",
+            key + (json.dumps(result),),
+        )
+
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+
+        self.conn.commit()
+        self._pending = 0
+
+    def invalidate(self, regbl=None, npa=None, all_versions=False):
+        """
+        Delete the results obtained with other tables than regbl and npa (the
+        tables of the last lookup if they are not given), or all the results
+        if all_versions=True, e.g. after RegBL was reloaded.
+        """
+
+        if all_versions is True:
+            cur = self.conn.execute("DELETE FROM geocoding")
+        else:
+            if regbl is not None and npa is not None:
+                version = self.tables_version(regbl, npa)
+            elif self._tables is not None:
+                version = self._tables[2]
+            else:
+                raise ValueError("regbl and npa are needed to invalidate")
+            cur = self.conn.execute(
+                "DELETE FROM geocoding WHERE version<>?", (version,)
+            )
+        self.commit()
+
+        return cur.rowcount
+
+    def close(self):
+
+        self.commit()
+        self.conn.close()
+
+
+# CLASS TO MEASURE THE GEOCODING CASCADE
+
+# GeocodingStats of the get_coords call in progress (if any)
+_active_stats = None
+
+
+class GeocodingStats:
+    """
+    Instrumentation of the get_coords cascade: number of calls and latencies
+    (total, mean, percentiles) of each case and of each sub-call
+    (search_regbl by mode, search_geoadmin, npa_centroid), and fallthrough
+    paths between cases (e.g. "CASE 6 > CASE 7 > CASE 8"). Give it to
+    get_coords (stats=...) and export the results with summary() or
+    to_json() after the run.
+    """
+
+    def __init__(self):
+
+        self.timings = defaultdict(list)
+        self.cases = Counter()
+        self.paths = Counter()
+        self._path = None
+
+    def record(self, name, seconds):
+
+        self.timings[name].append(seconds)
+
+    def enter(self, stage):
+        """Add a case to the path of the record in progress."""
+
+        if self._path is not None and (not self._path or self._path[-1] != stage):
+            self._path.append(stage)
+
+    def start(self):
+
+        self._path = []
+
+    def stop(self, case, seconds):
+
+        self.enter(case)
+        self.cases[case] += 1
+        self.paths[" > ".join(self._path)] += 1
+        self.record("get_coords", seconds)
+        self.record("get_coords[" + case + "]", seconds)
+        self._path = None
+
+    def summary(self):
+        """Statistics as a dict (latencies in milliseconds)."""
+
+        timings = {}
+        for name, values in sorted(self.timings.items()):
+            values = np.array(values) * 1000
+            timings[name] = {
+                "count": len(values),
+                "total_ms": round(float(values.sum()), 3),
+                "mean_ms": round(float(values.mean()), 3),
+                "p50_ms": round(float(np.percentile(values, 50)), 3),
+                "p90_ms": round(float(np.percentile(values, 90)), 3),
+                "p99_ms": round(float(np.percentile(values, 99)), 3),
+            }
+
+        return {
+            "cases": dict(self.cases),
+            "paths": dict(self.paths.most_common()),
+            "timings": timings,
+        }
+
+    def to_json(self, path=None):
+        """Statistics as JSON (written to path if given)."""
+
+        res = json.dumps(self.summary(), indent=1)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(res)
+
+        return res
+
+
+def _instrumented(name, stage=None):
+    """
+    Decorator timing a function of the cascade when get_coords runs with a
+    GeocodingStats. name(args, kwargs) gives the name of the record and
+    stage(args, kwargs) the case the call belongs to (None if not a case).
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            stats = _active_stats
+            if stats is None:
+                return func(*args, **kwargs)
+
+            if stage is not None:
+                stats.enter(stage(args, kwargs))
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.record(name(args, kwargs), time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def _regbl_mode(args, kwargs):
+
+    return "search_regbl[{}{}{}{}]".format(
+        kwargs.get("on", "building"),
+        "" if kwargs.get("use_npa", True) else ",gdename",
+        ",fuzzy" if kwargs.get("fuzzy_rue", True) else "",
+        ",closest" if kwargs.get("closest_num", False) else "",
+    )
+
+
+def _regbl_case(args, kwargs):
+
+    return {
+        ("building", False, False): "CASE 6",
+        ("building", True, False): "CASE 8",
+        ("street", False, False): "CASE 3",
+        ("street", True, False): "CASE 4",
+        ("street", False, True): "CASE 9",
+        ("street", True, True): "CASE 10",
+    }.get(
+        (
+            kwargs.get("on", "building"),
+            kwargs.get("fuzzy_rue", True),
+            kwargs.get("closest_num", False),
+        )
+    )
+
+
 # FUNCTION TO RETURN CENTROIDS OF THE NPA
 
 
+@_instrumented(lambda args, kwargs: "npa_centroid")
 def npa_centroid(ville, cp, npa):
+    """
+    Centroid (e, n) of a NPA, matched on locality name + NPA, or first
+    centroid of the NPA if the name does not match (NaN if unknown NPA). npa
+    is the dataframe of NPA centroids or a NPACentroids built on it.
+    """
+
+    if isinstance(npa, NPACentroids):
+        return npa.lookup(ville, cp)
 
     # Remove accents in municipalities
     npa["Ortschaftsname"] = npa.Ortschaftsname.map(strip_accents)
@@ -138,16 +1437,146 @@ def npa_centroid(ville, cp, npa):
     return e, n
 
 
-def get_coords(row, regbl, npa, level):
+class NPACentroids:
+    """
+    Prebuilt lookup of NPA centroids (same results as npa_centroid). The
+    locality names (Ortschaftsname) are normalized once and the centroids
+    are stored by (name, PLZ) and by PLZ (first centroid of the PLZ).
+    """
+
+    def __init__(self, npa):
+
+        self.npa = npa
+        self._version = None
+        names = normalize_addresses(npa.Ortschaftsname)
+
+        centroids = pd.DataFrame(
+            {
+                "ville": names.values,
+                "cp": npa.PLZ.values.astype(object),
+                "e": npa.E.values,
+                "n": npa.N.values,
+            }
+        )
+        self._by_name = centroids[
+            ~centroids.duplicated(["ville", "cp"]) & ~centroids.cp.isna()
+        ]
+        self._by_cp = centroids[
+            ~centroids.duplicated("cp") & ~centroids.cp.isna()
+        ][["cp", "e", "n"]]
+
+        self._name_dict = dict(
+            zip(
+                zip(self._by_name.ville.values, self._by_name.cp.values),
+                zip(self._by_name.e.values, self._by_name.n.values),
+            )
+        )
+        self._cp_dict = dict(
+            zip(
+                self._by_cp.cp.values,
+                zip(self._by_cp.e.values, self._by_cp.n.values),
+            )
+        )
+
+    @property
+    def version(self):
+        """Tag identifying the content of the NPA centroids."""
+
+        if self._version is None:
+            self._version = npa_version(self.npa)
+
+        return self._version
+
+    def lookup(self, ville, cp):
+        """Centroid (e, n) of a NPA (see npa_centroid)."""
+
+        try:
+            return self._name_dict[(ville, cp)]
+        except (KeyError, TypeError):
+            pass
+        try:
+            return self._cp_dict[cp]
+        except (KeyError, TypeError):
+            return np.nan, np.nan
+
+    def resolve(self, villes, cps):
+        """
+        Centroids of whole columns of locality names and NPA. Returns a
+        dataframe with the columns e and n (same index as villes).
+        """
+
+        query = pd.DataFrame(
+            {"ville": villes.values, "cp": np.asarray(cps, dtype=object)}
+        )
+        by_name = query.merge(
+            self._by_name, on=["ville", "cp"], how="left", indicator=True
+        )
+        by_cp = query.merge(self._by_cp, on="cp", how="left")
+
+        found = (by_name._merge == "both").values
+        res = pd.DataFrame(
+            {
+                "e": np.where(found, by_name.e.values, by_cp.e.values),
+                "n": np.where(found, by_name.n.values, by_cp.n.values),
+            },
+            index=villes.index,
+        )
+
+        return res
+
+
+def get_coords(row, regbl, npa, level, cache=None, stats=None):
+    """
+    Geocode an address (row with strname, deinr, npa, ville) with RegBL
+    (dataframe or RegBLIndex), the NPA centroids and the GeoAdmin API.
+    Returns e, n, egid, note_geocoding and the case of the cascade. Results
+    can be cached on disk (cache=GeocodingCache, except if the API request
+    failed) and the cascade can be measured (stats=GeocodingStats).
+    """
+
+    global _active_stats
+
+    if stats is None:
+        return _get_coords(row, regbl, npa, level, cache)
+
+    previous, _active_stats = _active_stats, stats
+    stats.start()
+    start = time.perf_counter()
+    try:
+        res = _get_coords(row, regbl, npa, level, cache)
+    finally:
+        _active_stats = previous
+    stats.stop(res[-1], time.perf_counter() - start)
+
+    return res
+
+
+def _get_coords(row, regbl, npa, level, cache=None):
 
     # print(row["index"])
 
-    addr = regbl.copy()
+    if cache is not None:
+        # Skip the geocoding if the address is in the cache (GeocodingCache)
+        key = cache.key(row, level, regbl, npa)
+        res = cache.get(key)
+        if res is not None:
+            return res
+
+    # The result is not cached if the API request failed (CASE 7)
+    api_failed = False
+
+    # Street numbers read as numbers (12 or 12.0) are searched as "12"
+    row.deinr = _number_key(row.deinr)
+
+    if isinstance(regbl, RegBLIndex):
+        known_npa = regbl.has_npa(row.npa)
+    else:
+        known_npa = bool((regbl.dplz4 == row.npa).any())
 
-    if not (row.npa in list(addr.dplz4.unique())):
+    if not known_npa:
         # If unknown NPA (e.g. 1014 -> administration), use locality name
-        # instead of NPA for all code
-        addr.dplz4 = addr.gdename
+        # instead of NPA for all code: RegBL is searched on gdename instead of
+        # dplz4 (use_npa=False), without modifying it
         row.npa = row.ville
 
     if pd.isnull(row.strname):
@@ -168,9 +1597,9 @@ def get_coords(row, regbl, npa, level):
             # print('CASE 3')
             e, n, egid = search_regbl(
                 row,
-                addr,
+                regbl,
                 on="street",
-                use_npa=True,
+                use_npa=known_npa,
                 fuzzy_rue=False,
                 closest_num=False,
                 fuzzy_level=level,
@@ -178,7 +1607,7 @@ def get_coords(row, regbl, npa, level):
             if egid is None:
                 e, n, egid = search_regbl(
                     row,
-                    addr,
+                    regbl,
                     on="street",
                     use_npa=False,
                     fuzzy_rue=False,
@@ -194,9 +1623,9 @@ def get_coords(row, regbl, npa, level):
                 # print('CASE 4')
                 e, n, egid = search_regbl(
                     row,
-                    addr,
+                    regbl,
                     on="street",
-                    use_npa=True,
+                    use_npa=known_npa,
                     fuzzy_rue=True,
                     closest_num=False,
                     fuzzy_level=level,
@@ -204,7 +1633,7 @@ def get_coords(row, regbl, npa, level):
                 if egid is None:
                     e, n, egid = search_regbl(
                         row,
-                        addr,
+                        regbl,
                         on="street",
                         use_npa=False,
                         fuzzy_rue=True,
@@ -233,9 +1662,9 @@ def get_coords(row, regbl, npa, level):
             # print('CASE 6')
             e, n, egid = search_regbl(
                 row,
-                addr,
+                regbl,
                 on="building",
-                use_npa=True,
+                use_npa=known_npa,
                 fuzzy_rue=False,
                 closest_num=False,
                 fuzzy_level=level,
@@ -243,7 +1672,7 @@ def get_coords(row, regbl, npa, level):
             if egid is None:
                 e, n, egid = search_regbl(
                     row,
-                    addr,
+                    regbl,
                     on="building",
                     use_npa=False,
                     fuzzy_rue=False,
@@ -266,14 +1695,19 @@ def get_coords(row, regbl, npa, level):
                 )
                 c = "CASE 7"
                 note_geocoding = "Geocoded at building. Fuzzy API."
+                # Offline and not in the response cache: same path as no
+                # match, but not cached (an online run may find a match)
+                offline_miss = label == "Not in cache (offline)"
+                api_failed = offline_miss or str(label).startswith(
+                    "Error code")
 
-                if label == "No match found":
+                if label == "No match found" or offline_miss:
                     # print('CASE 8')
                     e, n, egid = search_regbl(
                         row,
-                        addr,
+                        regbl,
                         on="building",
-                        use_npa=True,
+                        use_npa=known_npa,
                         fuzzy_rue=True,
                         closest_num=False,
                         fuzzy_level=level,
@@ -281,7 +1715,7 @@ def get_coords(row, regbl, npa, level):
                     if egid is None:
                         e, n, egid = search_regbl(
                             row,
-                            addr,
+                            regbl,
                             on="building",
                             use_npa=False,
                             fuzzy_rue=True,
@@ -297,9 +1731,9 @@ def get_coords(row, regbl, npa, level):
                     # print('CASE 9')
                     e, n, egid = search_regbl(
                         row,
-                        addr,
+                        regbl,
                         on="street",
-                        use_npa=True,
+                        use_npa=known_npa,
                         fuzzy_rue=False,
                         closest_num=True,
                         fuzzy_level=level,
@@ -307,7 +1741,7 @@ def get_coords(row, regbl, npa, level):
                     if egid is None:
                         e, n, egid = search_regbl(
                             row,
-                            addr,
+                            regbl,
                             on="street",
                             use_npa=False,
                             fuzzy_rue=False,
@@ -323,9 +1757,9 @@ def get_coords(row, regbl, npa, level):
                         # print('CASE 10')
                         e, n, egid = search_regbl(
                             row,
-                            addr,
+                            regbl,
                             on="street",
-                            use_npa=True,
+                            use_npa=known_npa,
                             fuzzy_rue=True,
                             closest_num=True,
                             fuzzy_level=level,
@@ -333,7 +1767,7 @@ def get_coords(row, regbl, npa, level):
                         if egid is None:
                             e, n, egid = search_regbl(
                                 row,
-                                addr,
+                                regbl,
                                 on="street",
                                 use_npa=False,
                                 fuzzy_rue=True,
@@ -360,9 +1794,243 @@ def get_coords(row, regbl, npa, level):
                                 note_geocoding = "Geocoded at NPA centroid."
                                 c = "CASE 12"
 
+    if cache is not None and not api_failed:
+        cache.put(key, (e, n, egid, note_geocoding, c))
+
     return e, n, egid, note_geocoding, c
 
 
+def geocode_batch(df, regbl, npa, level=0.9, stats=None, cache=None):
+    """
+    Geocode a whole dataset at once, with the same cascade as get_coords.
+    Exact matches at building (CASE 6) and at street (CASE 3) are resolved by
+    joining the dataset with RegBL, and only the remaining rows go through
+    get_coords (fuzzy matching, API, NPA centroids).
+
+    Inputs:
+    df = a dataframe containing at least the given fields: strname (street
+    name), deinr (street number), npa (postal code), ville (municipality)
+    regbl = a RegBL dataframe (see regbl_wrangling) or a RegBLIndex
+    npa = a dataframe with NPA centroids (see npa_centroid) or a NPACentroids
+    level = fuzzy match cutoff (see search_regbl)
+    stats = a GeocodingStats measuring the joins and the get_coords calls
+    cache = a GeocodingCache for the rows geocoded by get_coords (exact
+    matches are always joined)
+
+    Outputs:
+    a dataframe with the same index as df and the columns e, n, egid,
+    note_geocoding and case returned by get_coords
+    """
+
+    start = time.perf_counter()
+    if not isinstance(regbl, RegBLIndex):
+        regbl = RegBLIndex(regbl)
+    if not isinstance(npa, NPACentroids):
+        npa = NPACentroids(npa)
+
+    index = df.index
+    df = df.reset_index(drop=True)
+    # Street numbers read as numbers, same as get_coords (join and fallback)
+    df["deinr"] = _number_keys(df.deinr)
+
+    res = pd.DataFrame(
+        index=df.index,
+        columns=["e", "n", "egid", "note_geocoding", "case"],
+        dtype=object,
+    )
+    pos = pd.Series(np.nan, index=df.index)
+
+    # Unknown NPA are searched on municipality names only (see get_coords)
+    known_npa = df.npa.map(regbl.has_npa).astype(bool)
+    has_street = ~df.strname.isna()
+    has_number = ~df.deinr.isna()
+
+    for on, subset, cols in (
+        ("building", has_street & has_number, ["strname", "deinr"]),
+        ("street", has_street & ~has_number, ["strname"]),
+    ):
+        for mode, locality, mask in (
+            ("npa", "npa", known_npa),
+            ("gdename", "ville", subset),
+        ):
+            todo = subset & mask & pos.isna()
+            if not todo.any():
+                continue
+
+            if on == "building":
+                table = regbl.building_table(mode)
+            else:
+                table = regbl.street_table(mode)
+
+            query = df.loc[todo, [locality] + cols].rename(
+                columns={locality: "locality"}
+            )
+            query["_row"] = query.index
+            # Same key type as RegBL (e.g. npa read as floats)
+            if mode == "npa":
+                query["locality"] = query.locality.astype(
+                    table.locality.dtype)
+            matches = query.merge(
+                table, on=["locality"] + cols, how="inner")
+            pos.loc[matches._row.values] = matches._pos.values
+
+        found = subset & ~pos.isna()
+        positions = pos[found].astype(int).values
+        res.loc[found, "e"] = regbl._gkode[positions]
+        res.loc[found, "n"] = regbl._gkodn[positions]
+        res.loc[found, "egid"] = regbl._egid[positions]
+        if on == "building":
+            res.loc[found, "note_geocoding"] = "Geocoded at building."
+            res.loc[found, "case"] = "CASE 6"
+        else:
+            res.loc[found, "note_geocoding"] = "Geocoded at street."
+            res.loc[found, "case"] = "CASE 3"
+
+    if stats is not None:
+        stats.record("geocode_batch[join]", time.perf_counter() - start)
+        for case, count in res.case.value_counts().items():
+            stats.cases[case] += count
+            stats.paths[case + " (join)"] += count
+
+    # Fuzzy matching, API and NPA centroids for the remaining rows
+    for i, row in df[pos.isna()].iterrows():
+        res.loc[i] = get_coords(
+            row, regbl, npa, level, cache=cache, stats=stats)
+
+    res.index = index
+
+    return res
+
+
+class _PendingResults:
+    """
+    Stand-in for a GeocodingCache in the processes of geocode_parallel: the
+    results to cache are collected and returned to the main process, which
+    writes them to the cache.
+    """
+
+    def __init__(self):
+
+        self.results = []
+
+    def key(self, row, level, regbl, npa):
+
+        return (row.strname, row.deinr, row.npa, row.ville)
+
+    def get(self, key):
+
+        return None
+
+    def put(self, key, result):
+
+        self.results.append((key, result))
+
+
+def _geocode_shard(df, regbl_dat, notypo_first, npa, level, collect):
+
+    regbl = RegBLIndex(regbl_dat)
+    # Fuzzy matches without typo are resolved on the whole RegBL
+    regbl._notypo_first = notypo_first
+
+    pending = _PendingResults() if collect else None
+    res = geocode_batch(df, regbl, npa, level, cache=pending)
+
+    return res, pending.results if collect else []
+
+
+def geocode_parallel(df, regbl, npa, level=0.9, n_jobs=4, cache=None):
+    """
+    Geocode a whole dataset with geocode_batch in n_jobs processes (all the
+    cores if n_jobs is -1 or None). Records are sharded by locality (NPA, or
+    municipality name if the NPA is unknown) and each process only receives
+    the RegBL addresses of its localities (same dplz4 or gdename), which also
+    shortens the candidate lists of fuzzy matching. Results are the same as
+    geocode_batch and are returned in the order of df. With a GeocodingCache,
+    the addresses found in the cache are not geocoded again and the new
+    results are written to the cache by the main process.
+    """
+
+    if n_jobs is None or n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs < 1:
+        raise ValueError("n_jobs must be at least 1 (or -1 for all the cores)")
+
+    if isinstance(regbl, RegBLIndex):
+        regbl_dat = regbl.regbl
+        notypo_first = regbl._notypo_first
+    else:
+        regbl_dat = regbl
+        notypo_first = _first_notypo(regbl)
+
+    if df.empty:
+        return geocode_batch(df, regbl, npa, level, cache=cache)
+
+    index = df.index
+    df = df.reset_index(drop=True)
+    columns = ["e", "n", "egid", "note_geocoding", "case"]
+
+    # Addresses already in the cache
+    cached = {}
+    if cache is not None:
+        for i, row in df.iterrows():
+            hit = cache.get(cache.key(row, level, regbl, npa))
+            if hit is not None:
+                cached[i] = hit
+    todo = df[~df.index.isin(list(cached))]
+
+    # Locality of each record, as used by get_coords
+    npas = set(regbl_dat.dplz4.dropna().unique())
+    locality = todo.npa.where(todo.npa.isin(npas), todo.ville)
+
+    # Assign localities to shards (largest first, to the smallest shard)
+    sizes = locality.value_counts(sort=False, dropna=False)
+    order = np.argsort(-sizes.values, kind="stable")
+    nb_shards = min(n_jobs * 4, len(sizes))
+    loads = np.zeros(nb_shards, dtype=int)
+    shard_of = {}
+    for i in order:
+        shard = int(np.argmin(loads))
+        shard_of[sizes.index[i]] = shard
+        loads[shard] += sizes.values[i]
+    shards = locality.map(shard_of)
+
+    tasks = []
+    for shard in range(nb_shards):
+        shard_df = todo[shards == shard]
+        shard_regbl = regbl_dat[
+            regbl_dat.dplz4.isin(shard_df.npa)
+            | regbl_dat.gdename.isin(shard_df.ville)
+        ]
+        tasks.append(
+            (shard_df, shard_regbl, notypo_first, npa, level,
+             cache is not None)
+        )
+
+    if n_jobs == 1:
+        results = [_geocode_shard(*task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+            futures = [executor.submit(_geocode_shard, *t) for t in tasks]
+            results = [future.result() for future in futures]
+
+    if cache is not None:
+        for _, pending in results:
+            for fields, result in pending:
+                row = pd.Series(fields, index=["strname", "deinr", "npa",
+                                               "ville"])
+                cache.put(cache.key(row, level, regbl, npa), result)
+
+    res = pd.concat(
+        [shard_res for shard_res, _ in results]
+        + [pd.DataFrame.from_dict(cached, orient="index", columns=columns,
+                                  dtype=object)]
+    ).loc[df.index]
+    res.index = index
+
+    return res
+
+
+@_instrumented(_regbl_mode, _regbl_case)
 def search_regbl(
     row,
     list_addr,
@@ -401,8 +2069,21 @@ def search_regbl(
     e = x-coordinate for the matching adress (or None if no correspondance)
     n = y-coordinate for the matching adress (or None if no correspondance)
     egid = building ID
+
+    list_addr can also be a RegBLIndex built on the list of addresses, in
+    which case the search uses the index instead of scanning the dataframe.
     """
 
+    if isinstance(list_addr, RegBLIndex):
+        return list_addr.search(
+            row,
+            on=on,
+            use_npa=use_npa,
+            fuzzy_rue=fuzzy_rue,
+            closest_num=closest_num,
+            fuzzy_level=fuzzy_level,
+        )
+
     if use_npa is True:
         row_locality = row.npa
         addr_locality = list_addr.dplz4
@@ -412,7 +2093,7 @@ def search_regbl(
 
     if fuzzy_rue is True:
         try:
-            row_streetname = difflib.get_close_matches(
+            row_streetname = get_close_matches(
                 row.strname,
                 list_addr[addr_locality == row_locality].strname,
                 1,
@@ -420,16 +2101,15 @@ def search_regbl(
             )[0]
         except IndexError:
             try:
-                list_addr["strname_notypo"] = list_addr.strname.map(
-                    remove_typo_addr)
-                row_streetname = difflib.get_close_matches(
+                strname_notypo = list_addr.strname.map(remove_typo_addr)
+                row_streetname = get_close_matches(
                     remove_typo_addr(row.strname),
-                    list_addr[addr_locality == row_locality].strname_notypo,
+                    strname_notypo[addr_locality == row_locality],
                     1,
                     fuzzy_level,
                 )[0]
                 row_streetname = list_addr.loc[
-                    list_addr.strname_notypo == row_streetname, "strname"
+                    strname_notypo == row_streetname, "strname"
                 ].iloc[0]
             except IndexError:
                 e, n, egid = None, None, None
@@ -498,34 +2178,22 @@ def search_regbl(
     return e, n, egid
 
 
-def search_geoadmin(searchText):
-
-    time.sleep(0.1)
-    request = (
-        "https://api3.geo.admin.ch/rest/services/api/SearchServer?"
-        "layer=ch.bfs.gebaeude_wohnungs_register"
-        "&searchText=" + searchText + "&type=locations"
-        "&origins=address,zipcode"
-        "&sr=2056"
-    )
-    response = requests.get(request)
+@_instrumented(lambda args, kwargs: "search_geoadmin", lambda a, k: "CASE 7")
+def search_geoadmin(searchText, client=None):
+    """
+    Search an address with the SearchServer of the geo.admin.ch API. Requests
+    go through a GeoAdminClient (shared default client if client is None),
+    which pools connections and limits the request rate.
+    Outputs: e, n, egid, label of the first result (label is "No match found"
+    if there is no result, "Error code ..." if the request failed and "Not in
+    cache (offline)" for an offline client without cached response, handled
+    as no match by get_coords)
+    """
 
-    try:
-        res = response.json()["results"][0]
-        e = res["attrs"]["y"]
-        n = res["attrs"]["x"]
-        egid = int(res["attrs"]["featureId"].split("_")[0])
-        label = res["attrs"]["label"]
+    if client is None:
+        client = ga.default_client()
 
-    except IndexError:
-        if response.status_code == 200:
-            e, n, egid = None, None, None
-            label = "No match found"
-        else:
-            e, n, egid = None, None, None
-            label = "Error code" + str(response.status_code)
-
-    return e, n, egid, label
+    return client.search(searchText)
 
 
 def remove_typo_addr(strname):
@@ -539,44 +2207,97 @@ def remove_typo_addr(strname):
     return result
 
 
-def retrieve_egid_info(row, vd_addr):
+def retrieve_egid_info(row, vd_addr, client=None):
     """
     Function to retrieve strname / deinr for a given egid. First, the
     algorithm try to retrieve the information from RegBL (GEOSAN DB) and if it fails
     (no corresponding egid), the egid info is retrieved from GeoAdmin API
-    (new address).
+    (new address), with the given GeoAdminClient (or the default one).
+    vd_addr is the RegBL dataframe or an EgidIndex built on it. The EgidIndex
+    of a dataframe is built once and reused while the same dataframe is given
+    (build a new EgidIndex if the dataframe is modified in place).
     """
 
+    if not isinstance(vd_addr, EgidIndex):
+        vd_addr = _egid_index(vd_addr)
 
-    try:
-        res = vd_addr.loc[vd_addr.egid==row.egid]
-        strname = res.strname
-        deinr = res.deinr
+    strname_deinr = vd_addr.lookup(row.egid)
 
-        if not deinr:
-            strname_deinr = strname
-        else:
-            strname_deinr = strname + " " + deinr
+    if strname_deinr is None:
+
+        if client is None:
+            client = ga.default_client()
+        strname_deinr = client.find_egid(row.egid)
+
+    return strname_deinr
 
-    except IndexError:
 
-        time.sleep(0.1)
-        request = (
-            "https://api3.geo.admin.ch/rest/services/api/MapServer/"
-            "find?layer=ch.bfs.gebaeude_wohnungs_register&"
-            "searchText=" + str(int(row.egid)) + "&searchField=egid"
-            "&returnGeometry=false"
+# (weakref to the RegBL dataframe, its EgidIndex) of the last call
+_last_egid_index = None
+
+
+def _egid_index(vd_addr):
+    """EgidIndex of the RegBL dataframe, reused for the same dataframe."""
+
+    global _last_egid_index
+
+    if _last_egid_index is not None:
+        ref, index = _last_egid_index
+        if ref() is vd_addr:
+            return index
+
+    index = EgidIndex(vd_addr)
+    _last_egid_index = (weakref.ref(vd_addr), index)
+
+    return index
+
+
+class EgidIndex:
+    """
+    Prebuilt lookup of the address (strname_deinr, i.e. street name followed
+    by the street number if any) of each egid in RegBL (first address of the
+    building). resolve() retrieves a whole column of egids at once, and the
+    egids that are not in RegBL are sent to the GeoAdmin API in one batch.
+    Egids without street name in RegBL are considered not in RegBL (lookup
+    and resolve both use the API).
+    """
+
+    def __init__(self, vd_addr):
+
+        addr = vd_addr[~vd_addr.egid.isna() & ~vd_addr.strname.isna()]
+        addr = addr[~addr.duplicated("egid")]
+        has_number = ~addr.deinr.isna() & (addr.deinr.astype(str) != "")
+        strname_deinr = addr.strname.where(
+            ~has_number, addr.strname + " " + addr.deinr.astype(str)
         )
-        response = requests.get(request)
+
+        self._addresses = dict(zip(addr.egid.values, strname_deinr.values))
+
+    def lookup(self, egid):
+        """Address of an egid, None if the egid is not in RegBL."""
 
         try:
-            res = response.json()["results"][0]
-            strname_deinr = res["attributes"]["strname_deinr"][0]
+            return self._addresses.get(egid)
+        except TypeError:
+            return None
 
-        except Exception:
-            raise Exception("Sorry, egid not found")
+    def resolve(self, egids, client=None):
+        """
+        Addresses of a column of egids (same index). Egids that are not in
+        RegBL are retrieved with client.find_egids (the default client if
+        client is None), and are NaN if the API does not find them either.
+        """
 
-    return strname_deinr
+        res = egids.map(self._addresses)
+
+        missing = egids[res.isna() & ~egids.isna()].unique()
+        if len(missing) > 0:
+            if client is None:
+                client = ga.default_client()
+            found = dict(zip(missing, client.find_egids(list(missing))))
+            res = res.where(~res.isna(), egids.map(found))
+
+        return res
 
 
 def remove_subset(
@@ -626,7 +2347,7 @@ def find_egid(row, addr):
         note = "Direct match."
     except Exception:
         try:
-            fuzzy_rue = difflib.get_close_matches(
+            fuzzy_rue = get_close_matches(
                 row.strname, addr[addr.dplz4 == row.npa].strname, 1, 0.5
             )[0]
             # print(fuzzy_rue)
@@ -641,3 +2362,75 @@ def find_egid(row, addr):
             note = "No match found."
 
     return egid, note
+
+
+def find_egids(df, addr):
+    """
+    find_egid for a whole dataframe (strname, deinr, npa) at once, with the
+    same results. Exact matches on (strname, deinr, dplz4) are resolved with
+    one join on the addresses (first address if there are several), and
+    only the remaining rows go through fuzzy matching of the street name
+    (cutoff 0.5), with one FuzzyStreetIndex per NPA built once for all the
+    rows of this NPA.
+
+    Outputs: a dataframe with the same index as df and the columns egid and
+    note
+    """
+
+    keys = ["strname", "deinr", "dplz4"]
+    first = addr.loc[~addr[keys].isna().any(axis=1), keys + ["egid"]]
+    first = first[~first.duplicated(keys)]
+    lookup = dict(
+        zip(zip(first.strname, first.deinr, first.dplz4), first.egid)
+    )
+
+    query = pd.DataFrame(
+        {
+            "strname": df.strname.values,
+            "deinr": df.deinr.values,
+            "dplz4": df.npa.values,
+            "_row": np.arange(len(df)),
+        }
+    )
+    query = query[~query[keys].isna().any(axis=1)]
+    matches = query.merge(first, on=keys, how="inner")
+
+    egid = np.full(len(df), np.nan, dtype=object)
+    note = np.full(len(df), "No match found.", dtype=object)
+    egid[matches._row.values] = matches.egid.values
+    note[matches._row.values] = "Direct match."
+
+    # Fuzzy matching of the street name in the NPA for the remaining rows
+    todo = pd.DataFrame(
+        {
+            "strname": df.strname.values,
+            "deinr": df.deinr.values,
+            "npa": df.npa.values,
+        }
+    )[note != "Direct match."]
+    streets = addr.groupby("dplz4").strname
+
+    for npa, rows in todo.groupby("npa", sort=False):
+        if npa not in streets.groups:
+            continue
+        candidates = streets.get_group(npa)
+        # Same failure as difflib on missing street names
+        if not candidates.map(lambda x: isinstance(x, str)).all():
+            continue
+        index = FuzzyStreetIndex(candidates)
+
+        for i, strname, deinr in zip(rows.index, rows.strname, rows.deinr):
+            if not isinstance(strname, str):
+                continue
+            fuzzy_rue = index.best_match(strname, 0.5)
+            if fuzzy_rue is None:
+                continue
+            try:
+                egid[i] = lookup[(fuzzy_rue, deinr, npa)]
+                note[i] = "Fuzzy matching."
+            except (KeyError, TypeError):
+                pass
+
+    res = pd.DataFrame({"egid": egid, "note": note}, index=df.index)
+
+    return res
@@ -1,13 +1,19 @@
 # LIBRARIES
 # Basic
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import getpass
 import fiona
 import pandas as pd
 import os
+import queue
 import sys
+import time
 
 # Spatial
 import geopandas as gpd
-from shapely.geometry import Point
 
 
 # CONNECT TO GEOSAN DB
@@ -15,127 +21,53 @@ sys.path.append(r"/mnt/data/GEOSAN/FUNCTIONS/GIRAPH-functions/")
 try:
     import db_utils as db
     import basic_utils as u
+    import geocoding_utils as g
 except FileNotFoundError:
     print("Wrong file or file path")
 
 
-def main():
+# DIRECTORIES
+geosan_db_dir: str = r"/mnt/data/GEOSAN/GEOSAN DB/data"
 
-    # DIRECTORIES
-    geosan_db_dir: str = r"/mnt/data/GEOSAN/GEOSAN DB/data"
 
-    # IMPORT DATA
-    # Cantons
-    cantons = gpd.read_file(
-        os.sep.join(
-            [
-                geosan_db_dir,
-                "SWISS TLM REGIO/2022/swissTLMRegio_Boundaries_LV95/swissTLMRegio_KANTONSGEBIET_LV95.shp",
-            ]
-        )
-    )
-    cantons.crs = 2056
-    # Remove Z-dimension
-    cantons = u.convert_3D_to_2D(cantons)
-    # Import to GEOSAN DB
-    db.import_data("geosan", "aladoy", cantons, "cantons", "uuid", idx_geom=True)
+# READERS
 
-    # Districts
-    districts = gpd.read_file(
-        os.sep.join(
-            [
-                geosan_db_dir,
-                "SWISS TLM REGIO/2022/swissTLMRegio_Boundaries_LV95/swissTLMRegio_BEZIRKSGEBIET_LV95.shp",
-            ]
-        )
-    )
-    districts.crs = 2056
-    districts = u.convert_3D_to_2D(districts)
-    db.import_data("geosan", "aladoy", districts, "districts", "uuid", idx_geom=True)
 
-    # Municipalities
-    # Use SWISS TLM REGIO dataset instead of SWISS BOUNDARIES because lakes are separated from municipalities
-    municipalities = gpd.read_file(
-        os.sep.join(
-            [
-                geosan_db_dir,
-                "SWISS TLM REGIO/2022/swissTLMRegio_Boundaries_LV95/swissTLMRegio_HOHEITSGEBIET_LV95.shp",
-            ]
-        )
-    )
-    municipalities.crs = 2056
-    municipalities = u.convert_3D_to_2D(municipalities)
-    db.import_data(
-        "geosan", "aladoy", municipalities, "municipalities", "objectid", idx_geom=True
-    )
+def read_file(path, **options):
 
-    # HECTOMETRIC GRID
-    reli = gpd.read_file(
-        os.sep.join([geosan_db_dir, "STATPOP/2021/statpop.gpkg"]),
-        driver="GPKG",
-        layer="statpop_reli",
-    )
-    reli = reli[["RELI", "E_KOORD", "N_KOORD", "B21BTOT", "geometry"]]
-    db.import_data("geosan", "aladoy", reli, "reli_point", "reli", idx_geom=True)
-    centroid = gpd.read_file(
-        os.sep.join([geosan_db_dir, "STATPOP/2021/statpop.gpkg"]),
-        driver="GPKG",
-        layer="statpop_centroid",
-    )
-    centroid = centroid[["RELI", "E_KOORD", "N_KOORD", "B21BTOT", "geometry"]]
-    db.import_data("geosan", "aladoy", centroid, "reli_centroid", "reli", idx_geom=True)
+    return gpd.read_file(path, **options)
 
-    ha_polygon = gpd.read_file(
-        os.sep.join([geosan_db_dir, "STATPOP/2021/statpop.gpkg"]),
-        driver="GPKG",
-        layer="statpop_polygon",
-    )
-    ha_polygon = ha_polygon[["RELI", "E_KOORD", "N_KOORD", "B21BTOT", "geometry"]]
-    db.import_data(
-        "geosan", "aladoy", ha_polygon, "reli_polygon", "reli", idx_geom=True
-    )
 
-    # MICROREGIONS
+def read_csv(path, **options):
+
+    return pd.read_csv(path, **options)
+
+
+def read_microregions(path):
+
     mreg = gpd.read_file(
-        os.sep.join(
-            [
-                geosan_db_dir,
-                "MICROGIS/MICROREGIONS 2017/JOOSTSPECIAL_NB_2017.shp",
-            ]
-        ),
-        driver="ESRI Shapefile",
+        os.sep.join([path, "JOOSTSPECIAL_NB_2017.shp"]), driver="ESRI Shapefile"
     )
     mreg_dat = pd.read_csv(
-        os.sep.join(
-            [geosan_db_dir, "MICROGIS/MICROREGIONS 2017/JOOSTSPECIAL_NB_2017.csv"]
-        ),
-        engine="python",
+        os.sep.join([path, "JOOSTSPECIAL_NB_2017.csv"]), engine="python"
     )
     mreg = pd.merge(mreg, mreg_dat, on="NBID", how="inner")
-    db.import_data(
-        "geosan", "aladoy", mreg, "microgis_microreg", "NBID", ifexists="replace"
-    )
 
-    # HA LEVEL
+    return mreg
+
+
+def read_microgis_ha(path):
+
     mha_demo = pd.read_csv(
-        os.sep.join([geosan_db_dir, "MICROGIS/2021/DEMO/HA_DEMO.csv"]),
-        engine="python",
-        skipfooter=1,
-    )
-    mha_rdemo = pd.read_csv(
-        os.sep.join([geosan_db_dir, "MICROGIS/2021/DEMO/HA_DEMO.csv"]),
-        engine="python",
-        skipfooter=1,
+        os.sep.join([path, "DEMO/HA_DEMO.csv"]), engine="python", skipfooter=1
     )
     mha_income = pd.read_csv(
-        os.sep.join([geosan_db_dir, "MICROGIS/2021/INCOME_IQMD/HA_INCOME_IQMD.csv"]),
+        os.sep.join([path, "INCOME_IQMD/HA_INCOME_IQMD.csv"]),
         engine="python",
         skipfooter=1,
     )
     mha_soceco = pd.read_csv(
-        os.sep.join([geosan_db_dir, "MICROGIS/2021/SOCECO/HA_SOCECO.csv"]),
-        engine="python",
-        skipfooter=1,
+        os.sep.join([path, "SOCECO/HA_SOCECO.csv"]), engine="python", skipfooter=1
     )
     mha = mha_demo.drop(["mfd_id", "gde_21", "bz_21", "kt_21"], axis=1).merge(
         mha_income.drop(["mfd_id", "gde_21", "bz_21", "kt_21", "ch_21"], axis=1),
@@ -143,165 +75,441 @@ def main():
         how="inner",
     )
     mha = mha.merge(mha_soceco.drop(["mfd_id"], axis=1), on=["reli"], how="inner")
-    db.import_data("geosan", "aladoy", mha, "microgis_ha", "reli")
 
-    # MUNICIPALITY LEVEL
-    mmun_demo = pd.read_csv(
-        os.sep.join([geosan_db_dir, "MICROGIS/2021/DEMO/SF_DEMO_GD_2021.csv"]),
-        encoding="iso-8859-1",
-    )
-    mmun_demo.columns = mmun_demo.columns.str.replace(" ", "")
-    mmun_rdemo = pd.read_csv(
-        os.sep.join([geosan_db_dir, "MICROGIS/2021/DEMO/SF_DEMORATIO_GD_2021.csv"]),
-        encoding="iso-8859-1",
-    )
-    mmun_rdemo.columns = mmun_rdemo.columns.str.replace(" ", "")
-    mmun_income = pd.read_csv(
-        os.sep.join(
-            [geosan_db_dir, "MICROGIS/2021/INCOME_IQMD/SF_INCOME_TP_IQMD_GD_2021.csv"]
-        ),
-        encoding="utf-8",
-    )
-    mmun_income.columns = mmun_income.columns.str.replace(" ", "")
-    mmun_soceco = pd.read_csv(
-        os.sep.join([geosan_db_dir, "MICROGIS/2021/SOCECO/SF_SOCECO_GD_2021.csv"]),
-        encoding="iso-8859-1",
-    )
-    mmun_soceco.columns = mmun_soceco.columns.str.replace(" ", "")
-    mmun_rsoceco = pd.read_csv(
-        os.sep.join([geosan_db_dir, "MICROGIS/2021/SOCECO/SF_SOCECORATIO_GD_2021.csv"]),
-        encoding="iso-8859-1",
-    )
-    mmun_rsoceco.columns = mmun_rsoceco.columns.str.replace(" ", "")
-    mmun = mmun_demo.merge(
-        mmun_rdemo.drop(
-            ["GDENAME", "BZNR", "BZNAME", "KTACRO", "KTNAME", "CENTER_X", "CENTER_Y"],
-            axis=1,
-        ),
-        on="GDENR",
-        how="inner",
-    )
-    mmun = mmun.merge(
-        mmun_income.drop(
-            ["GDENAME", "BZNR", "BZNAME", "KTACRO", "KTNAME", "CENTER_X", "CENTER_Y"],
-            axis=1,
-        ),
-        on="GDENR",
-        how="inner",
-    )
-    mmun = mmun.merge(
-        mmun_soceco.drop(
-            ["GDENAME", "BZNR", "BZNAME", "KTACRO", "KTNAME", "CENTER_X", "CENTER_Y"],
-            axis=1,
-        ),
-        on="GDENR",
-        how="inner",
-    )
-    mmun = mmun.merge(
-        mmun_rsoceco.drop(
-            ["GDENAME", "BZNR", "BZNAME", "KTACRO", "KTNAME", "CENTER_X", "CENTER_Y"],
-            axis=1,
-        ),
-        on="GDENR",
-        how="inner",
-    )
-    db.import_data("geosan", "aladoy", mmun, "microgis_mun", "gdenr")
+    return mha
 
-    # STATPOP (2021)
-    statpop = pd.read_csv(
-        os.sep.join([geosan_db_dir, "STATPOP/2021/STATPOP2021.csv"]), sep=";"
-    )
-    db.import_data(
-        "geosan", "aladoy", statpop, "statpop2021", "RELI", ifexists="replace"
-    )
 
-    # REGBL (2021)
-    vd_addr = pd.read_csv(os.sep.join([geosan_db_dir, "REGBL/2021/VD.csv"]), sep=";")
-    # Remove accents in object type
-    vd_addr["GDENAME"] = vd_addr.GDENAME.map(g.strip_accents)
-    vd_addr["STRNAME"] = vd_addr.STRNAME.map(g.strip_accents)
-    vd_addr["DPLZNAME"] = vd_addr.DPLZNAME.map(g.strip_accents)
-    # Convert object type to upper case
-    vd_addr["GDENAME"] = vd_addr.GDENAME.map(str.upper)
-    vd_addr["STRNAME"] = vd_addr.STRNAME.map(str.upper)
-    vd_addr["DPLZNAME"] = vd_addr.DPLZNAME.map(str.upper)
-    # Create a geometry column using Shapely
-    vd_addr = vd_addr.assign(
-        geometry=vd_addr.apply(lambda row: Point(row.gkode, row.gkodn), axis=1)
-    )
-    vd_addr = gpd.GeoDataFrame(vd_addr, geometry=vd_addr.geometry, crs="EPSG:2056")
-    # Convert to geodataframe
-    db.import_data("geosan", "aladoy", vd_addr, "regbl2021", "egid,edid", idx_geom=True)
+def read_microgis_mun(path):
 
-    # DISTANCE TO SERVICES (OFS, 2018)
-    dist_serv = pd.read_csv(
-        os.sep.join(
-            [geosan_db_dir, "ACCESSIBILITY TO SERVICES/ag-b-00.03-2018spop-csv.csv"]
-        ),
-        delimiter=";",
-    )
-    db.import_data(
-        "geosan", "aladoy", dist_serv, "distance_services", "RELI", ifexists="replace"
-    )
+    files = [
+        ("DEMO/SF_DEMO_GD_2021.csv", "iso-8859-1"),
+        ("DEMO/SF_DEMORATIO_GD_2021.csv", "iso-8859-1"),
+        ("INCOME_IQMD/SF_INCOME_TP_IQMD_GD_2021.csv", "utf-8"),
+        ("SOCECO/SF_SOCECO_GD_2021.csv", "iso-8859-1"),
+        ("SOCECO/SF_SOCECORATIO_GD_2021.csv", "iso-8859-1"),
+    ]
+    tables = []
+    for file, encoding in files:
+        dat = pd.read_csv(os.sep.join([path, file]), encoding=encoding)
+        dat.columns = dat.columns.str.replace(" ", "")
+        tables.append(dat)
 
-    # PLAYGROUNDS (OSM, 2022)
-    playgrounds = gpd.read_file(
-        os.sep.join([geosan_db_dir, "PLAYGROUNDS VD/Jan 23/playgrounds_VD_2056.gpkg"])
-    )
-    playgrounds.reset_index(drop=False, inplace=True)
-    db.import_data(
-        "geosan", "aladoy", playgrounds, "playgrounds", "index", ifexists="replace"
-    )
+    mmun = tables[0]
+    for dat in tables[1:]:
+        mmun = mmun.merge(
+            dat.drop(
+                ["GDENAME", "BZNR", "BZNAME", "KTACRO", "KTNAME", "CENTER_X", "CENTER_Y"],
+                axis=1,
+            ),
+            on="GDENR",
+            how="inner",
+        )
 
-    # PUBLIC TRANSPORT (ARE, 2022)
-    pub_transport = gpd.read_file(
-        os.sep.join([geosan_db_dir, "PUBLIC TRANSPORT/2022/OeV_Gueteklassen_ARE.gpkg"]),
-        layer="OeV_Haltestellen_ARE",
-    )
-    db.import_data(
-        "geosan",
-        "aladoy",
-        pub_transport,
-        "public_transport_stops",
-        "Haltestellen_No",
-        ifexists="replace",
-    )
+    return mmun
 
-    # LAKES (SWISSTOPO, 2022)
-    lakes = gpd.read_file(
-        os.sep.join(
-            [
-                geosan_db_dir,
-                "SWISS TLM REGIO/2022/swissTLMRegio_Product_LV95/Hydrography/swissTLMRegio_Lake.shp",
-            ]
-        )
+
+# TRANSFORMATIONS
+
+
+def set_lv95(dat):
+
+    dat.crs = 2056
+
+    return dat
+
+
+def select_columns(dat, columns):
+
+    return dat[columns]
+
+
+def reset_index(dat):
+
+    return dat.reset_index(drop=False)
+
+
+def regbl_transform(chunk):
+
+    # Remove accents in object type and convert to upper case
+    chunk["GDENAME"] = g.normalize_addresses(chunk.GDENAME)
+    chunk["STRNAME"] = g.normalize_addresses(chunk.STRNAME)
+    chunk["DPLZNAME"] = g.normalize_addresses(chunk.DPLZNAME)
+    # Create a geometry column and convert to geodataframe
+    chunk = gpd.GeoDataFrame(
+        chunk,
+        geometry=gpd.points_from_xy(chunk.gkode, chunk.gkodn),
+        crs="EPSG:2056",
     )
-    lakes.crs = 2056
-    db.import_data("geosan", "aladoy", lakes, "lakes", "objectid", idx_geom=True)
 
+    return chunk
+
+
+def apply_transforms(dat, transforms):
+
+    for transform in transforms:
+        dat = transform(dat)
+
+    return dat
+
+
+# MANIFEST OF THE LAYERS
+# name: target table
+# read: reader, called with the path of the source and the options
+# source: path of the source in geosan_db_dir
+# transforms: functions applied to the data (to each chunk if chunked)
+# pk, idx_geom, ifexists, method: see db.import_data
+# chunked: stream the source by chunks (read returns an iterator of chunks)
+# depends: layers to import before this one
+
+_tlm_boundaries = "SWISS TLM REGIO/2022/swissTLMRegio_Boundaries_LV95/"
+_tlm_product = "SWISS TLM REGIO/2022/swissTLMRegio_Product_LV95/"
+_reli_columns = functools.partial(
+    select_columns, columns=["RELI", "E_KOORD", "N_KOORD", "B21BTOT", "geometry"]
+)
+
+LAYERS = [
+    # Cantons
+    {
+        "name": "cantons",
+        "read": read_file,
+        "source": _tlm_boundaries + "swissTLMRegio_KANTONSGEBIET_LV95.shp",
+        "transforms": [set_lv95, u.convert_3D_to_2D],
+        "pk": "uuid",
+        "idx_geom": True,
+    },
+    # Districts
+    {
+        "name": "districts",
+        "read": read_file,
+        "source": _tlm_boundaries + "swissTLMRegio_BEZIRKSGEBIET_LV95.shp",
+        "transforms": [set_lv95, u.convert_3D_to_2D],
+        "pk": "uuid",
+        "idx_geom": True,
+    },
+    # Municipalities
+    # Use SWISS TLM REGIO dataset instead of SWISS BOUNDARIES because lakes are separated from municipalities
+    {
+        "name": "municipalities",
+        "read": read_file,
+        "source": _tlm_boundaries + "swissTLMRegio_HOHEITSGEBIET_LV95.shp",
+        "transforms": [set_lv95, u.convert_3D_to_2D],
+        "pk": "objectid",
+        "idx_geom": True,
+    },
+    # HECTOMETRIC GRID
+    {
+        "name": "reli_point",
+        "read": read_file,
+        "source": "STATPOP/2021/statpop.gpkg",
+        "options": {"driver": "GPKG", "layer": "statpop_reli"},
+        "transforms": [_reli_columns],
+        "pk": "reli",
+        "idx_geom": True,
+    },
+    {
+        "name": "reli_centroid",
+        "read": read_file,
+        "source": "STATPOP/2021/statpop.gpkg",
+        "options": {"driver": "GPKG", "layer": "statpop_centroid"},
+        "transforms": [_reli_columns],
+        "pk": "reli",
+        "idx_geom": True,
+    },
+    {
+        "name": "reli_polygon",
+        "read": read_file,
+        "source": "STATPOP/2021/statpop.gpkg",
+        "options": {"driver": "GPKG", "layer": "statpop_polygon"},
+        "transforms": [_reli_columns],
+        "pk": "reli",
+        "idx_geom": True,
+    },
+    # MICROREGIONS
+    {
+        "name": "microgis_microreg",
+        "read": read_microregions,
+        "source": "MICROGIS/MICROREGIONS 2017",
+        "pk": "NBID",
+    },
+    # HA LEVEL
+    {
+        "name": "microgis_ha",
+        "read": read_microgis_ha,
+        "source": "MICROGIS/2021",
+        "pk": "reli",
+    },
+    # MUNICIPALITY LEVEL
+    {
+        "name": "microgis_mun",
+        "read": read_microgis_mun,
+        "source": "MICROGIS/2021",
+        "pk": "gdenr",
+    },
+    # STATPOP (2021)
+    {
+        "name": "statpop2021",
+        "read": u.read_csv_chunks,
+        "source": "STATPOP/2021/STATPOP2021.csv",
+        "options": {"sep": ";"},
+        "pk": "RELI",
+        "chunked": True,
+    },
+    # REGBL (2021)
+    {
+        "name": "regbl2021",
+        "read": u.read_csv_chunks,
+        "source": "REGBL/2021/VD.csv",
+        "options": {"sep": ";"},
+        "transforms": [regbl_transform],
+        "pk": "egid,edid",
+        "idx_geom": True,
+        "chunked": True,
+    },
+    # DISTANCE TO SERVICES (OFS, 2018)
+    {
+        "name": "distance_services",
+        "read": read_csv,
+        "source": "ACCESSIBILITY TO SERVICES/ag-b-00.03-2018spop-csv.csv",
+        "options": {"delimiter": ";"},
+        "pk": "RELI",
+    },
+    # PLAYGROUNDS (OSM, 2022)
+    {
+        "name": "playgrounds",
+        "read": read_file,
+        "source": "PLAYGROUNDS VD/Jan 23/playgrounds_VD_2056.gpkg",
+        "transforms": [reset_index],
+        "pk": "index",
+    },
+    # PUBLIC TRANSPORT (ARE, 2022)
+    {
+        "name": "public_transport_stops",
+        "read": read_file,
+        "source": "PUBLIC TRANSPORT/2022/OeV_Gueteklassen_ARE.gpkg",
+        "options": {"layer": "OeV_Haltestellen_ARE"},
+        "pk": "Haltestellen_No",
+    },
+    # LAKES (SWISSTOPO, 2022)
+    {
+        "name": "lakes",
+        "read": read_file,
+        "source": _tlm_product + "Hydrography/swissTLMRegio_Lake.shp",
+        "transforms": [set_lv95],
+        "pk": "objectid",
+        "idx_geom": True,
+    },
     # ROADS (SWISSTOPO, 2022)
-    roads = gpd.read_file(
-        os.sep.join(
-            [
-                geosan_db_dir,
-                "SWISS TLM REGIO/2022/swissTLMRegio_Product_LV95/Transportation/swissTLMRegio_Road.shp",
-            ]
-        )
+    {
+        "name": "roads",
+        "read": u.read_file_chunks,
+        "source": _tlm_product + "Transportation/swissTLMRegio_Road.shp",
+        "transforms": [set_lv95],
+        "pk": "objectid",
+        "idx_geom": True,
+        "chunked": True,
+    },
+    # BUILDINGS (SWISSTOPO, 2022)
+    {
+        "name": "buildings",
+        "read": u.read_file_chunks,
+        "source": _tlm_product + "Buildings/swissTLMRegio_Building.shp",
+        "transforms": [set_lv95],
+        "pk": "objectid",
+        "idx_geom": True,
+        "chunked": True,
+    },
+]
+
+
+# RUNNER
+
+
+def prepare_layer(layer, data_dir):
+    """Read and transform a layer (in a worker process)."""
+
+    start = time.perf_counter()
+    dat = layer["read"](
+        os.sep.join([data_dir, layer["source"]]), **layer.get("options", {})
     )
-    roads.crs = 2056
-    db.import_data("geosan", "aladoy", roads, "roads", "objectid", idx_geom=True)
+    dat = apply_transforms(dat, layer.get("transforms", []))
 
-    # BUILDINGS (SWISSTOPO, 2022)
-    build = gpd.read_file(
-        os.sep.join(
-            [
-                geosan_db_dir,
-                "SWISS TLM REGIO/2022/swissTLMRegio_Product_LV95/Buildings/swissTLMRegio_Building.shp",
-            ]
-        )
+    return dat, time.perf_counter() - start
+
+
+def load_layer(layer, dat, sessions, data_dir):
+    """
+    Import a layer into GEOSAN DB with one of the pooled sessions (in a
+    thread). Chunked layers are read, transformed and imported here, chunk
+    by chunk.
+    """
+
+    start = time.perf_counter()
+    session = sessions.get()
+    try:
+        if layer.get("chunked", False):
+            db.import_data_chunked(
+                "geosan",
+                "aladoy",
+                layer["read"](
+                    os.sep.join([data_dir, layer["source"]]),
+                    **layer.get("options", {})
+                ),
+                layer["name"],
+                layer["pk"],
+                idx_geom=layer.get("idx_geom", False),
+                ifexists=layer.get("ifexists", "replace"),
+                transform=functools.partial(
+                    apply_transforms, transforms=layer.get("transforms", [])
+                ),
+                session=session,
+            )
+        else:
+            db.import_data(
+                "geosan",
+                "aladoy",
+                dat,
+                layer["name"],
+                layer["pk"],
+                idx_geom=layer.get("idx_geom", False),
+                ifexists=layer.get("ifexists", "replace"),
+                session=session,
+                method=layer.get("method", "insert"),
+            )
+    except Exception:
+        session.conn.rollback()
+        raise
+    finally:
+        sessions.put(session)
+
+    return time.perf_counter() - start
+
+
+def run_layers(layers, jobs=4, data_dir=geosan_db_dir):
+    """
+    Import the layers of the manifest into GEOSAN DB. Reads and
+    transformations run in a pool of jobs processes and imports in jobs
+    threads, each one with its own session (pooled connections). A layer
+    starts as soon as the layers it depends on are imported, so independent
+    layers are imported at the same time.
+    Outputs: dataframe with the status and the time (seconds) of the read,
+    the import and the whole layer
+    """
+
+    by_name = {layer["name"]: layer for layer in layers}
+    pending = dict(by_name)
+    done, failed = set(), set()
+    timings = {name: {"read_s": 0.0, "load_s": 0.0} for name in by_name}
+    start = time.perf_counter()
+
+    # Sessions on GEOSAN DB (same password for all the connections)
+    password = db.find_password("geosan", "aladoy")
+    if password is None:
+        password = getpass.getpass()  # Ask for user password
+    sessions = queue.Queue()
+    with contextlib.ExitStack() as stack:
+        for _ in range(jobs):
+            sessions.put(
+                stack.enter_context(
+                    db.GeosanDB("geosan", "aladoy", password=password)
+                )
+            )
+
+        futures = {}
+        with concurrent.futures.ProcessPoolExecutor(jobs) as processes:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as threads:
+                while pending or futures:
+
+                    # Start the layers whose dependencies are imported
+                    for name, layer in list(pending.items()):
+                        depends = [d for d in layer.get("depends", []) if d in by_name]
+                        if any(d in failed for d in depends):
+                            print("LAYER", name, "SKIPPED (a dependency failed)")
+                            failed.add(name)
+                            del pending[name]
+                        elif all(d in done for d in depends):
+                            timings[name]["start"] = time.perf_counter()
+                            if layer.get("chunked", False):
+                                future = threads.submit(
+                                    load_layer, layer, None, sessions, data_dir
+                                )
+                                futures[future] = ("load", name)
+                            else:
+                                future = processes.submit(
+                                    prepare_layer, layer, data_dir
+                                )
+                                futures[future] = ("read", name)
+                            del pending[name]
+
+                    if not futures:
+                        raise ValueError(
+                            "Circular dependencies between layers: "
+                            + ", ".join(pending)
+                        )
+
+                    finished, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in finished:
+                        step, name = futures.pop(future)
+                        try:
+                            res = future.result()
+                        except Exception as e:
+                            print("LAYER", name, "FAILED:", repr(e))
+                            failed.add(name)
+                            continue
+
+                        if step == "read":
+                            dat, timings[name]["read_s"] = res
+                            future = threads.submit(
+                                load_layer, by_name[name], dat, sessions, data_dir
+                            )
+                            futures[future] = ("load", name)
+                        else:
+                            timings[name]["load_s"] = res
+                            timings[name]["total_s"] = (
+                                time.perf_counter() - timings[name]["start"]
+                            )
+                            done.add(name)
+
+    res = pd.DataFrame(
+        [
+            {
+                "layer": name,
+                "status": "imported" if name in done else "failed",
+                "read_s": round(timings[name]["read_s"], 1),
+                "load_s": round(timings[name]["load_s"], 1),
+                "total_s": round(timings[name].get("total_s", 0.0), 1),
+            }
+            for name in by_name
+        ]
+    )
+    print(res.to_string(index=False))
+    print("Total time :", round(time.perf_counter() - start, 1), "s")
+
+    return res
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Import the layers into GEOSAN DB.")
+    parser.add_argument(
+        "--jobs", type=int, default=4, help="number of layers imported in parallel"
+    )
+    parser.add_argument(
+        "--layers", nargs="+", help="layers to import (all the layers by default)"
     )
-    build.crs = 2056
-    db.import_data("geosan", "aladoy", build, "buildings", "objectid", idx_geom=True)
+    args = parser.parse_args()
+
+    layers = LAYERS
+    if args.layers is not None:
+        unknown = set(args.layers) - {layer["name"] for layer in LAYERS}
+        if unknown:
+            parser.error("unknown layers: " + ", ".join(sorted(unknown)))
+        layers = [layer for layer in LAYERS if layer["name"] in args.layers]
+
+    res = run_layers(layers, args.jobs)
+    if (res.status != "imported").any():
+        sys.exit(1)
 
 
 if __name__ == "__main__":
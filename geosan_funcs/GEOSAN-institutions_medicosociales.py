@@ -209,20 +209,12 @@ def main():
     # Convert NPA to integer
     institutions["NPA"] = institutions.NPA.map(int)
 
-    # Convert all in upper case + remove accents
-    institutions["NOM"] = institutions.NOM.map(g.strip_accents).map(str.upper)
-    institutions["RUE"] = institutions.RUE.map(g.strip_accents).map(str.upper)
-    institutions["LOCALITE"] = institutions.LOCALITE.map(g.strip_accents).map(str.upper)
-    institutions.loc[~institutions.NOTE.isna(), "NOTE"] = (
-        institutions.loc[~institutions.NOTE.isna(), "NOTE"]
-        .map(g.strip_accents)
-        .map(str.upper)
-    )
-    institutions.loc[~institutions.EXPLOITANT.isna(), "EXPLOITANT"] = (
-        institutions.loc[~institutions.EXPLOITANT.isna(), "EXPLOITANT"]
-        .map(g.strip_accents)
-        .map(str.upper)
-    )
+    # Convert all in upper case + remove accents (missing values are kept)
+    institutions["NOM"] = g.normalize_addresses(institutions.NOM)
+    institutions["RUE"] = g.normalize_addresses(institutions.RUE)
+    institutions["LOCALITE"] = g.normalize_addresses(institutions.LOCALITE)
+    institutions["NOTE"] = g.normalize_addresses(institutions.NOTE)
+    institutions["EXPLOITANT"] = g.normalize_addresses(institutions.EXPLOITANT)
 
     # Drop index
     institutions.reset_index(drop=False, inplace=True)
@@ -1,8 +1,195 @@
 '''This code contains several functions that are useful while geocoding health data possibly within medicosocial institutions'''
 
+# LIBRARIES
+import sys
+import numpy as np
+import pandas as pd
+
+# Import functions from GIRAPH-functions repository
+sys.path.append(r"/mnt/data/GEOSAN/FUNCTIONS/GIRAPH-functions/")
+try:
+    import geocoding_utils as g
+except FileNotFoundError:
+    print("Wrong file or file path")
+
+
+# INDEX OF THE INSTITUTIONS BY NPA AND LOCALITY
+class InstitutionIndex:
+    '''Prebuilt index of the institutions (table institutions_medicosociales)
+    to match many records with the same results as find_institutions and
+    check_if_institution. Exact matches are dictionaries, and the candidate
+    names, names + notes and streets of each NPA / locality are fuzzy indexes
+    (g.FuzzyStreetIndex) built once. The batch methods resolve each distinct
+    record of a frame only once.'''
+
+    def __init__(self, institutions):
+
+        self.institutions = institutions
+        self._npa_groups = institutions.groupby('npa').indices
+        self._locality_groups = institutions.groupby('localite').indices
+        self._fuzzy = {}
+
+        self._nom = institutions.nom.values
+        self._rue = institutions.rue.values
+        self._full_info = (institutions.nom + institutions.note).values
+
+        self._by_name = self._first(['nom', 'npa'], 'nom')
+        self._by_address = self._first(['rue', 'numero', 'npa'], 'nom')
+        self._by_address_locality = self._first(
+            ['rue', 'numero', 'localite'], 'nom')
+
+        # First name of each name + note, by locality
+        self._full_info_nom = {}
+        for key, nom in zip(
+                zip(institutions.localite.values, self._full_info), self._nom):
+            self._full_info_nom.setdefault(key, nom)
+
+    def _first(self, keys, value):
+        '''First value of each combination of keys (missing keys never
+        match, as with ==)'''
+
+        dat = self.institutions[list(dict.fromkeys(keys + [value]))]
+        dat = dat[~dat[keys].isna().any(axis=1)]
+        dat = dat[~dat.duplicated(keys)]
+
+        return dict(
+            zip(zip(*[dat[k].values for k in keys]), dat[value].values))
+
+    def _fuzzy_index(self, column, by, key):
+        '''Fuzzy index of a column (nom, full_info or rue) for the
+        institutions of an NPA or a locality, None if there is none or if a
+        value is missing (get_close_matches fails in both cases).'''
+
+        if (column, by, key) not in self._fuzzy:
+            groups = self._npa_groups if by == 'npa' else self._locality_groups
+            try:
+                positions = groups[key]
+            except (KeyError, TypeError):
+                positions = []
+            values = {'nom': self._nom, 'full_info': self._full_info,
+                      'rue': self._rue}[column][positions]
+            if len(values) == 0 or not all(
+                    isinstance(v, str) for v in values):
+                index = None
+            else:
+                index = g.FuzzyStreetIndex(values)
+            self._fuzzy[(column, by, key)] = index
+
+        return self._fuzzy[(column, by, key)]
+
+    def _best_match(self, word, column, by, key, cutoff):
+
+        index = self._fuzzy_index(column, by, key)
+        if index is None or not isinstance(word, str):
+            return None
+
+        return index.best_match(word, cutoff)
+
+    def find(self, strname, npa, ville):
+        '''Institution name and note of an address (see
+        find_institutions)'''
+
+        try:
+            return self._by_name[(strname, npa)], 'Good match'
+        except (KeyError, TypeError):
+            pass
+
+        res = self._best_match(strname, 'nom', 'npa', npa, 0.5)
+        if res is not None:
+            return res, 'Fuzzy match npa'
+
+        res_full = self._best_match(strname, 'full_info', 'localite', ville,
+                                    0.5)
+        if res_full is not None:
+            res = self._full_info_nom[(ville, res_full)]
+            return res, 'Fuzzy match npa bis'
+
+        res = self._best_match(strname, 'nom', 'localite', ville, 0.6)
+        if res is not None:
+            return res, 'Fuzzy match loc'
+
+        return 'NAN', 'No match'
+
+    def check(self, match_strname, match_deinr, npa, ville):
+        '''Name of the institution at an address, NaN if none (see
+        check_if_institution)'''
+
+        try:
+            return self._by_address[(match_strname, match_deinr, npa)]
+        except (KeyError, TypeError):
+            pass
+
+        fuzzy_rue = self._best_match(match_strname, 'rue', 'npa', npa, 0.9)
+        if fuzzy_rue is not None:
+            try:
+                return self._by_address[(fuzzy_rue, match_deinr, npa)]
+            except (KeyError, TypeError):
+                pass
+
+        fuzzy_rue = self._best_match(match_strname, 'rue', 'localite', ville,
+                                     0.9)
+        if fuzzy_rue is not None:
+            try:
+                return self._by_address_locality[
+                    (fuzzy_rue, match_deinr, ville)]
+            except (KeyError, TypeError):
+                pass
+
+        return np.nan
+
+    def _apply(self, df, cols, func):
+
+        keys = df[cols].drop_duplicates()
+        res = [func(*key) for key in keys.itertuples(index=False)]
+
+        return keys, res
+
+    def find_institutions(self, df):
+        '''find_institutions for a whole dataframe (strname, npa, ville).
+        Returns a dataframe with the columns nom and note (same index as
+        df).'''
+
+        cols = ['strname', 'npa', 'ville']
+        keys, res = self._apply(df, cols, self.find)
+        keys['nom'] = [r[0] for r in res]
+        keys['note'] = [r[1] for r in res]
+
+        return self._broadcast(df, cols, keys, ['nom', 'note'])
+
+    def check_if_institution(self, df):
+        '''check_if_institution for a whole dataframe (match_strname,
+        match_deinr, npa, ville). Returns the institution names (same index
+        as df).'''
+
+        cols = ['match_strname', 'match_deinr', 'npa', 'ville']
+        keys, res = self._apply(df, cols, self.check)
+        keys['nom_institution'] = res
+
+        return self._broadcast(df, cols, keys,
+                               ['nom_institution']).nom_institution
+
+    def _broadcast(self, df, cols, keys, results):
+        '''Results of the distinct records for all the rows of df'''
+
+        # Missing values are matched together, as in drop_duplicates
+        keys = keys.reset_index(drop=True)
+        merged = df[cols].reset_index(drop=True).merge(
+            keys.assign(_key=np.arange(len(keys))), on=cols, how='left')
+
+        res = keys.loc[merged._key.values, results]
+        res.index = df.index
+
+        return res
+
 
 # FIND IF THE ADDRESS IS AN INSTITUTION'S NAME
 def find_institutions(row, institutions):
+    '''Institution name (and note on the match) of the address of a record
+    (strname, npa, ville). institutions is the institutions table or an
+    InstitutionIndex built on it.'''
+
+    if isinstance(institutions, InstitutionIndex):
+        return institutions.find(row.strname, row.npa, row.ville)
 
     try:
         res = institutions.loc[
@@ -12,7 +199,7 @@ def find_institutions(row, institutions):
 
     except Exception:
         try:
-            res = difflib.get_close_matches(
+            res = g.get_close_matches(
                 row.strname,
                 institutions[institutions.npa == row.npa].nom, 1, 0.5)[0]
             note = 'Fuzzy match npa'
@@ -21,7 +208,7 @@ def find_institutions(row, institutions):
             try:
                 list_instit = institutions[institutions.localite == row.ville]
                 list_instit['full_info'] = list_instit.nom + list_instit.note
-                res_full = difflib.get_close_matches(
+                res_full = g.get_close_matches(
                     row.strname,
                     list_instit.full_info,
                     1, 0.5)[0]
@@ -31,7 +218,7 @@ def find_institutions(row, institutions):
 
             except Exception:
                 try:
-                    res = difflib.get_close_matches(
+                    res = g.get_close_matches(
                         row.strname,
                         institutions[institutions.localite == row.ville].nom,
                         1, 0.6)[0]
@@ -46,6 +233,13 @@ def find_institutions(row, institutions):
 
 # FIND IF ADDRESSES CORRESPONDS TO AN INSTITUTION'S ADDRESS
 def check_if_institution(row, institutions):
+    '''Name of the institution at the address of a record (match_strname,
+    match_deinr, npa, ville), NaN if none. institutions is the institutions
+    table or an InstitutionIndex built on it.'''
+
+    if isinstance(institutions, InstitutionIndex):
+        return institutions.check(
+            row.match_strname, row.match_deinr, row.npa, row.ville)
 
     try:
         nom_institution = institutions.loc[
@@ -54,7 +248,7 @@ def check_if_institution(row, institutions):
             & (institutions.npa == row.npa), 'nom'].values[0]
     except Exception:
         try:
-            fuzzy_rue = difflib.get_close_matches(
+            fuzzy_rue = g.get_close_matches(
                 row.match_strname,
                 institutions[institutions.npa == row.npa].rue,
                 1, 0.9)[0]
@@ -64,7 +258,7 @@ def check_if_institution(row, institutions):
                 & (institutions.npa == row.npa), 'nom'].values[0]
         except Exception:
             try:
-                fuzzy_rue = difflib.get_close_matches(
+                fuzzy_rue = g.get_close_matches(
                     row.match_strname,
                     institutions[institutions.localite == row.ville].rue,
                     1, 0.9)[0]
@@ -91,6 +285,15 @@ def geocode_institution(row, cursor):
     except Exception:
         raise Exception("Sorry, institution must be into the database")
 
+    return resolve_institution(res, row.npa, row.ville)
+
+
+def resolve_institution(res, npa, ville):
+    '''Coordinates and address (gkode, gkodn, strname_deinr) of an
+    institution among the rows of the table with its name (ST_X, ST_Y, npa,
+    localite, rue, numero): the only row, or the first one in the same NPA,
+    or else in the same locality'''
+
     if len(res) == 1:
         gkode = res[0][0]
         gkodn = res[0][1]
@@ -100,14 +303,14 @@ def geocode_institution(row, cursor):
     elif len(res) > 1:
 
         try:
-            item = [i for i in res if i[2] == row.npa]
+            item = [i for i in res if i[2] == npa]
             gkode = item[0][0]
             gkodn = item[0][1]
             strname = item[0][4]
             deinr = item[0][5]
 
         except Exception:
-            item = [i for i in res if i[3] == row.ville]
+            item = [i for i in res if i[3] == ville]
             gkode = item[0][0]
             gkodn = item[0][1]
             strname = item[0][4]
@@ -122,3 +325,42 @@ def geocode_institution(row, cursor):
         strname_deinr = strname + " " + deinr
 
     return gkode, gkodn, strname_deinr
+
+
+# RETRIEVE COORDINATES FOR ALL THE INSTITUTIONS OF A DATASET
+def geocode_institutions(df, cursor):
+    '''geocode_institution for a whole dataframe (institution_nom, npa,
+    ville) with a single query: the rows of all the institution names are
+    fetched at once (nom = ANY(...)) and each record is resolved in memory
+    with the same NPA / locality disambiguation. Returns a dataframe with the
+    columns gkode, gkodn and strname_deinr (same index as df).'''
+
+    if df.institution_nom.isna().any():
+        raise Exception("Sorry, institution must be into the database")
+
+    names = list(df.institution_nom.unique())
+    try:
+        cursor.execute(("SELECT nom, ST_X(geometry), ST_Y(geometry),"
+                        "npa, localite, rue, numero "
+                        "FROM institutions_medicosociales "
+                        "WHERE nom = ANY(%s)"), (names,))
+        rows = cursor.fetchall()
+    except Exception:
+        raise Exception("Sorry, institution must be into the database")
+
+    # Rows of each institution, in the order of the table
+    by_name = {}
+    for row in rows:
+        by_name.setdefault(row[0], []).append(row[1:])
+
+    res = {}
+    for nom, npa, ville in zip(df.institution_nom, df.npa, df.ville):
+        if (nom, npa, ville) not in res:
+            res[(nom, npa, ville)] = resolve_institution(
+                by_name.get(nom, []), npa, ville)
+
+    coords = pd.DataFrame(
+        [res[key] for key in zip(df.institution_nom, df.npa, df.ville)],
+        columns=['gkode', 'gkodn', 'strname_deinr'], index=df.index)
+
+    return coords
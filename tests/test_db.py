@@ -0,0 +1,88 @@
+# test_db.py
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("geoalchemy2")
+psycopg2_sql = pytest.importorskip("psycopg2.sql")
+import geopandas as gpd
+from shapely.geometry import Point, Polygon
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db_utils as d
+
+
+class FakeCursor:
+    """Cursor that records the SQL statements instead of running them."""
+
+    def __init__(self):
+        self.log = []
+
+    def execute(self, query, params=None):
+        if not isinstance(query, str):
+            query = query.as_string(self)
+        self.log.append(query)
+
+    def copy_expert(self, query, buf):
+        self.log.append(query)
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+class FakeSession:
+    def __init__(self):
+        self.engine = None
+        self.conn = self
+        self.cursor = FakeCursor()
+
+    def commit(self):
+        pass
+
+
+def _column_type(log):
+    """Geometry type of the table after the CREATE and ALTER statements (the
+    CREATE TABLE IF NOT EXISTS of the appended chunks does nothing)."""
+
+    col_type = None
+    for query in log:
+        created = query.startswith("CREATE TABLE ") and "IF NOT EXISTS" not in query
+        if created or " ALTER COLUMN " in query:
+            col_type = query.split("geometry(")[-1].split(")")[0]
+
+    return col_type
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 4, 5])
+def test_import_data_chunked_geometry_type(monkeypatch, size):
+
+    # Identifiers quoted without a database connection
+    monkeypatch.setattr(
+        psycopg2_sql.ext, "quote_ident", lambda s, ctx: '"' + s + '"'
+    )
+    # Point, Z point and polygon: the type changes at some chunk boundaries
+    dat = gpd.GeoDataFrame(
+        {"id": [1, 2, 3, 4, 5]},
+        geometry=[
+            Point(0, 0),
+            Point(1, 1),
+            Point(0, 0, 5),
+            Polygon([(0, 0), (1, 0), (1, 1)]),
+            Point(2, 2),
+        ],
+        crs=2056,
+    )
+    chunks = [dat.iloc[i : i + size] for i in range(0, len(dat), size)]
+
+    session = FakeSession()
+    d.import_data_chunked(
+        "geosan", "user", iter(chunks), "tab", "NULL", session=session
+    )
+
+    assert _column_type(session.cursor.log) == "GEOMETRYZ, 2056"
+    assert d.geometry_type(dat)[0] == "geometry(GEOMETRYZ, 2056)"
@@ -0,0 +1,118 @@
+# test_geocoding.py
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark_utils as b
+import geoadmin_utils as ga
+import geocoding_utils as g
+
+
+@pytest.fixture(scope="module")
+def data():
+    """Synthetic RegBL, NPA centroids and addresses (API on a local stub)."""
+
+    regbl = b.synthetic_regbl(2000, n_localities=4, seed=1)
+    npa = b.synthetic_npa(regbl)
+    queries = b.synthetic_queries(regbl, 300, seed=1)
+    queries = queries[["strname", "deinr", "npa", "ville"]]
+
+    previous = ga._default_client
+    with ga.GeoAdminStubServer() as server:
+        ga.set_default_client(
+            ga.GeoAdminClient(base_url=server.url, rate=10000, retries=0)
+        )
+        yield g.RegBLIndex(regbl), g.NPACentroids(npa), queries
+    ga.set_default_client(previous)
+
+
+def _row_by_row(df, regbl, npa):
+
+    res = [g.get_coords(row.copy(), regbl, npa, 0.9) for _, row in df.iterrows()]
+
+    return pd.DataFrame(
+        res, index=df.index, columns=["e", "n", "egid", "note_geocoding", "case"]
+    )
+
+
+@pytest.mark.parametrize("kind", ["str", "int", "float"])
+def test_geocode_batch_same_as_get_coords(data, kind):
+
+    regbl, npa, queries = data
+    # Street numbers without letters, as read from a file with numbers only
+    df = queries[
+        queries.deinr.isna() | queries.deinr.astype(str).str.isdigit()
+    ].copy()
+    if kind == "int":
+        df = df[~df.deinr.isna()]
+        df["deinr"] = df.deinr.astype(int)
+    elif kind == "float":
+        df["deinr"] = df.deinr.astype(float)
+
+    batch = g.geocode_batch(df, regbl, npa, 0.9)
+    expected = _row_by_row(df, regbl, npa)
+
+    pd.testing.assert_frame_equal(batch, expected, check_dtype=False)
+
+
+def test_geocode_unique_does_not_depend_on_row_order(data):
+
+    regbl, npa, queries = data
+    # Same addresses written differently
+    variants = queries.copy()
+    variants["strname"] = " " + variants.strname.str.lower() + " "
+    variants["ville"] = variants.ville.str.title()
+    df = pd.concat([queries, variants], ignore_index=True)
+    cols = ["e", "n", "egid", "note_geocoding", "case"]
+
+    _, indivs = g.geocode_unique(df, regbl, npa, 0.9)
+    _, reverse = g.geocode_unique(df.iloc[::-1], regbl, npa, 0.9)
+
+    pd.testing.assert_frame_equal(
+        indivs[cols], reverse[cols].loc[indivs.index], check_dtype=False
+    )
+
+
+def test_geocoding_cache(data, tmp_path):
+
+    regbl, npa, queries = data
+    expected = g.geocode_batch(queries, regbl, npa, 0.9)
+
+    with g.GeocodingCache(str(tmp_path / "cache.sqlite")) as cache:
+        first = g.geocode_batch(queries, regbl, npa, 0.9, cache=cache)
+        # Second run from the cache, also with the shards of geocode_parallel
+        second = g.geocode_parallel(
+            queries, regbl, npa, 0.9, n_jobs=2, cache=cache)
+        n_cached = cache.conn.execute(
+            "SELECT COUNT(*) FROM geocoding").fetchone()[0]
+
+        # Missing and empty values, other tables: different keys
+        row = queries.iloc[0].copy()
+        empty = row.copy()
+        row["ville"], empty["ville"] = np.nan, ""
+        assert cache.key(row, 0.9, regbl, npa) != cache.key(empty, 0.9, regbl, npa)
+        other = g.NPACentroids(npa.npa.iloc[1:])
+        assert cache.key(row, 0.9, regbl, npa) != cache.key(row, 0.9, regbl, other)
+
+    assert n_cached > 0
+    pd.testing.assert_frame_equal(first, expected)
+    pd.testing.assert_frame_equal(second, expected, check_dtype=False)
+
+
+def test_retrieve_egid_info_same_as_resolve():
+
+    vd_addr = b.synthetic_regbl(500, n_localities=2, seed=2)
+    vd_addr.loc[vd_addr.index[:50], "deinr"] = np.nan
+    df = vd_addr.sample(100, random_state=0)[["egid"]]
+
+    # RegBL dataframe, indexed once and reused for all the rows
+    res = df.apply(lambda row: g.retrieve_egid_info(row, vd_addr), axis=1)
+    expected = g.EgidIndex(vd_addr).resolve(df.egid)
+
+    pd.testing.assert_series_equal(res, expected, check_names=False)
+    assert g._egid_index(vd_addr) is g._egid_index(vd_addr)